@@ -8,32 +8,14 @@ import re
 import sys
 import zlib
 
+from x4_archives import CatArchive
+
 try:
     import lz4.block
     _HAVE_LZ4 = True
 except ImportError:
     _HAVE_LZ4 = False
 
-def parse_cat(cat_path):
-    """
-    Parse a .cat index file and yield tuples of (name, offset, size).
-    """
-    entries = []
-    offset = 0
-    with open(cat_path, 'r', encoding='utf-8', errors='ignore') as f:
-        for line in f:
-            parts = line.rstrip('\n').rsplit(' ', 3)
-            if len(parts) < 2:
-                continue
-            name = parts[0]
-            try:
-                size = int(parts[1])
-            except ValueError:
-                continue
-            entries.append((name, offset, size))
-            offset += size
-    return entries
-
 def decompress_block(data):
     """
     Decompress a data block using zlib or LZ4 if needed, or return raw data.
@@ -63,18 +45,15 @@ def scan_archive(cat_path, values, report, debug=False):
         return
     if debug:
         print(f"[DEBUG] Processing CAT: {cat_path}, DAT: {dat_path}")
-    entries = parse_cat(cat_path)
-    if debug:
-        xml_count = sum(1 for name, _, _ in entries if name.lower().endswith('.xml'))
-        print(f"[DEBUG]  parsed {len(entries)} entries ({xml_count} XML files)")
-    with open(dat_path, 'rb') as dat:
-        for name, offset, size in entries:
-            if not name.lower().endswith('.xml'):
-                continue
+    with CatArchive(cat_path) as archive:
+        if debug:
+            xml_count = sum(1 for _ in archive.entries('*.xml'))
+            print(f"[DEBUG]  parsed {len(archive.index)} entries ({xml_count} XML files)")
+        for entry in archive.entries('*.xml'):
+            name, offset, size = entry
             if debug:
                 print(f"[DEBUG]   entry: {name} @ {offset} (+{size} bytes)")
-            dat.seek(offset)
-            blob = dat.read(size)
+            blob = archive.read(entry)
             data = decompress_block(blob)
             try:
                 text = data.decode('utf-8', errors='replace')
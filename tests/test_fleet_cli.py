@@ -0,0 +1,77 @@
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MINER = os.path.join(REPO, "x4-save-miner.py")
+
+OFFSET = '<offset><position x="%d" y="0" z="0"/></offset>'
+
+def station(code, x, kind, price):
+    return ('<connection connection="stations"><component class="station" '
+            'macro="station_gen_factory_base_01_macro" code="%s" owner="argon" id="[0x%s]">%s'
+            '<trade><offers><production><trade id="[0x%s1]" %s="x" ware="energycells" '
+            'price="%d" amount="5000"/></production></offers></trade></component></connection>'
+            % (code, code[-1], OFFSET % x, code[-1], kind, price))
+
+def ship(code, x, player=False):
+    cockpit = ('<connection connection="cockpit"><component class="cockpit" macro="x" id="[0xc%s]">'
+               '<connections><connection connection="entities"><component class="player" '
+               'macro="character_player" id="[0xd%s]"/></connection></connections></component></connection>'
+               % (code[-1], code[-1])) if player else ''
+    return ('<connection connection="ships"><component class="ship_s" '
+            'macro="ship_arg_s_trans_container_01_a_macro" code="%s" owner="player" spawntime="0" id="[0xe%s]">%s'
+            '<connections><connection connection="con_storage"><component class="storage" '
+            'macro="storage_arg_s_trans_container_01_b_macro" id="[0xf%s]"/></connection>%s'
+            '</connections></component></connection>' % (code, code[-1], OFFSET % x, code[-1], cockpit))
+
+SAVE = ('<?xml version="1.0" encoding="UTF-8"?><savegame><info><player name="P" money="100000000"/></info>'
+        '<universe><component class="galaxy" macro="xu_ep2_universe_macro" id="[0x1]"><connections>'
+        '<connection connection="clusters"><component class="cluster" macro="cluster_01_macro" id="[0x2]">'
+        + OFFSET % 0 + '<connections><connection connection="sectors">'
+        '<component class="sector" macro="cluster_01_sector001_macro" code="SEC-001" owner="argon" id="[0x3]">'
+        + OFFSET % 0 + '<connections><connection connection="zones">'
+        '<component class="zone" macro="tzonecluster_01_sector001shcon1_gatezone_macro" id="[0x5]">'
+        + OFFSET % 5000 + '<connections/></component></connection><connection connection="zones">'
+        '<component class="zone" macro="zone001_cluster_01_sector001_macro" id="[0x4]">'
+        + OFFSET % 0 + '<connections>'
+        + station("AAA-001", 0, "seller", 1000)
+        + station("BBB-002", 10000, "buyer", 2000)
+        + ship("SHP-001", 1000, player=True)
+        + ship("SHP-002", 2000)
+        + ship("SHP-003", 3000)
+        + '</connections></component></connection></connections></component></connection>'
+        '</connections></component></connection></connections></component></universe></savegame>')
+
+class FleetCliTest(unittest.TestCase):
+    """--fleet must see the cargo hold of every player-owned ship however the
+    savefile is loaded, although normal runs prune ship subtrees early."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.savefile = os.path.join(self.tmp.name, "fleet.xml")
+        with open(self.savefile, "w") as f:
+            f.write(SAVE)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def fleet(self, *flags):
+        out = subprocess.run([sys.executable, MINER, self.savefile, "--fleet"] + list(flags),
+                             cwd=REPO, capture_output=True, text=True, check=True).stdout
+        fleet = out.split("\nFleet Trades\n", 1)[1]
+        return sorted(line.split()[1] for line in fleet.splitlines() if line.startswith("Ship: "))
+
+    def test_every_player_ship_gets_a_trade(self):
+        ships = ["SHP-001", "SHP-002", "SHP-003"]
+        self.assertEqual(self.fleet("--no-snapshot"), ships)
+        self.assertEqual(self.fleet("--no-snapshot", "--no-stream"), ships)
+        self.assertEqual(self.fleet("-w", "-i", "3", "--no-snapshot"), ships)
+        # the first run writes a snapshot and the second one loads it
+        self.assertEqual(self.fleet(), ships)
+        self.assertEqual(self.fleet(), ships)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -29,15 +29,25 @@ from lxml import etree
 import gzip
 import sys
 import argparse
+import os
 from os import listdir
-from os.path import isfile, isdir, join
+from os.path import isfile, isdir, join, normpath, abspath, splitext
 import json
+import hashlib
 import re
 import glob
+import multiprocessing
+try:
+    import resource
+except ImportError:
+    resource = None
+from x4_archives import CatArchive
 
 parser = argparse.ArgumentParser()
 parser.add_argument("x4folder", help="The location of your X4 installation")
 parser.add_argument("-l", "--langid", default="44", help="The language ID for names (default == 44 (English))")
+parser.add_argument("-j", "--jobs", type=int, default=1, help="Number of worker processes to mine the archives with (0 == one per CPU, default == 1)")
+parser.add_argument("-f", "--full", action="store_true", help="Mine every archive again instead of reusing the results of unchanged ones")
 args = parser.parse_args()
 
 offsetFiles = [
@@ -57,27 +67,208 @@ if len(sys.argv) < 2:
     parser.print_usage()
     sys.exit(1)
 
-def fetchXmlwithCat(x4dir, filename):
+# With --jobs, archive entries are handed to the workers in chunks of
+# about this many bytes
+JOB_CHUNK_SIZE = 4 * 1024 * 1024
+
+# The results of each pass over each archive are kept in this file next to
+# the json outputs, so that a re-run only mines the archives that changed
+MANIFEST_FILE = "x4-cat-manifest.json"
+MANIFEST_VERSION = 2
+previousManifest = {'archives': {}, 'results': {}, 'outputs': {}}
+manifest = {'version': MANIFEST_VERSION, 'archives': {}, 'results': {}, 'outputs': {}}
+
+# Each archive is opened once per run and the entries in sharedEntries are
+# parsed at most once: documents maps (catfile, entry) to their parsed root
+# until releaseDocuments() drops it.  A parsed document takes many times the
+# size of its XML, so only the smallest of the entries that more than one
+# pass reads are shared, up to DOCUMENT_CACHE_SIZE bytes of XML in all, and
+# the others are parsed again by every pass.
+DOCUMENT_CACHE_SIZE = 2 * 1024 * 1024
+archives = {}
+documents = {}
+sharedEntries = set()
+
+def openArchive(x4dir, filename):
+    catfile = normpath(join(x4dir, filename))
+    archive = archives.get(catfile)
+    if archive is None:
+        archive = archives[catfile] = CatArchive(catfile)
+        for line in archive.skipped:
+            print("Error: failed to parse catfile: " + line)
+    return archive
+
+# Only the entries matching one of the glob patterns are read from the
+# archive, e.g. ['libraries/wares.xml'] or ['*/macros/*.xml'].  Each
+# content is a memoryview into the mapped .dat, which lxml 6 parses in place.
+# A list of entries from the archive's index can be given instead.
+def fetchXmlwithCat(x4dir, filename, patterns=('*.xml',), entries=None):
     catfile = join(x4dir, filename)
-    datfile = catfile[0:-3] + "dat"
-    offset = 0
     xmlfiles = []
     print("Processing catfile: " + catfile)
-    with open(catfile, 'r') as cat:
-        for line in cat.readlines():
-            deets = line.rsplit(" ", 3)
-            if (len(deets) < 4):
-                print("Error: failed to parse catfile: " + line)
-                continue
-            if deets[0].endswith(".xml"):
-                with open(datfile, 'rb') as dat:
-                    dat.seek(offset)
-                    data = dat.read(int(deets[1])).decode('utf-8')
-                    xmlfiles += [{'name': deets[0], 'content': data}]
-                    print("Added: " + deets[0])
-            offset += int(deets[1])
+    archive = openArchive(x4dir, filename)
+    if entries is None:
+        entries = archive.entries(patterns)
+    for entry in entries:
+        xmlfiles += [{'name': entry[0], 'content': archive.view(entry), 'key': (archive.cat_path, entry)}]
+        print("Added: " + entry[0])
     return xmlfiles
 
+def parseXml(rawxml):
+    key = rawxml['key']
+    root = documents.get(key)
+    if root is None:
+        try:
+            root = etree.fromstring(rawxml['content'])
+        except ValueError:
+            # lxml before 6.0 only parses bytes and strings, not memoryviews
+            root = etree.fromstring(rawxml['content'].tobytes())
+        if key in sharedEntries:
+            documents[key] = root
+    return root
+
+# The set of (catfile, entry) keys a pass over files will fetch.
+def passEntries(x4dir, files, patterns=('*.xml',)):
+    keys = set()
+    for file in files:
+        archive = openArchive(x4dir, file)
+        keys.update((archive.cat_path, entry) for entry in archive.entries(patterns))
+    return keys
+
+# Choose the entries whose parsed documents are kept: the smallest of
+# those that a pass and a later one both read.
+def shareEntries(passes):
+    shared = set()
+    for i, keys in enumerate(passes):
+        shared.update(keys.intersection(set().union(*passes[i + 1:])))
+    budget = DOCUMENT_CACHE_SIZE
+    for key in sorted(shared, key=lambda key: (key[1][2], key)):
+        budget -= key[1][2]
+        if budget < 0:
+            break
+        sharedEntries.add(key)
+
+# Drop the parsed documents that no later pass will read.
+def releaseDocuments(keep):
+    for key in list(documents):
+        if key not in keep:
+            del documents[key]
+
+def mineEntries(task):
+    extract, x4dir, filename, entries, extra = task
+    return extract(fetchXmlwithCat(x4dir, filename, entries=entries), *extra)
+
+# Run extract(xmlstrings, *extra) over the matching entries of each file and
+# return the results in file order, so merging them with update() gives
+# the same output whether or not a pool is used.  With a pool every file is
+# split into chunks that are mined in parallel, and the results of its
+# chunks are merged in order.
+def minePass(pool, extract, files, patterns, *extra):
+    if pool is None:
+        return [extract(fetchXmlwithCat(args.x4folder, file, patterns), *extra) for file in files]
+    tasks = []
+    owners = []
+    for index, file in enumerate(files):
+        chunk = []
+        size = 0
+        for entry in openArchive(args.x4folder, file).entries(patterns):
+            chunk.append(entry)
+            size += entry[2]
+            if size >= JOB_CHUNK_SIZE:
+                tasks.append((extract, args.x4folder, file, chunk, extra))
+                owners.append(index)
+                chunk = []
+                size = 0
+        if chunk:
+            tasks.append((extract, args.x4folder, file, chunk, extra))
+            owners.append(index)
+    results = [{} for file in files]
+    for index, result in zip(owners, pool.map(mineEntries, tasks, chunksize=1)):
+        results[index].update(result)
+    return results
+
+def loadManifest(path):
+    try:
+        with open(path, encoding='utf-8') as f:
+            loaded = json.load(f)
+    except (OSError, ValueError):
+        loaded = None
+    if not isinstance(loaded, dict) or loaded.get('version') != MANIFEST_VERSION:
+        return {'archives': {}, 'results': {}, 'outputs': {}}
+    return loaded
+
+# An archive is identified by a hash of its .cat, which lists the size and
+# checksum of every entry, and the size of its .dat.  The hash is only
+# computed again when the size or modification time of either file changed.
+def archiveHash(filename):
+    catfile = abspath(join(args.x4folder, filename))
+    known = manifest['archives'].get(catfile)
+    if known is not None:
+        return known['hash']
+    stamp = []
+    for path in (catfile, splitext(catfile)[0] + '.dat'):
+        st = os.stat(path)
+        stamp += [st.st_size, st.st_mtime_ns]
+    known = previousManifest['archives'].get(catfile)
+    if known is None or known['stamp'] != stamp:
+        with open(catfile, 'rb') as f:
+            digest = hashlib.sha1(f.read())
+        digest.update(str(stamp[2]).encode())
+        known = {'stamp': stamp, 'hash': digest.hexdigest()}
+    manifest['archives'][catfile] = known
+    return known['hash']
+
+def resultKey(name, filename):
+    return name + ':' + abspath(join(args.x4folder, filename))
+
+# Return the files whose result for pass name has to be mined again: the
+# previous run did not record one, or depends(file), whatever the result
+# was computed from, changed since.  A file listed twice is mined once.
+def staleFiles(name, files, depends):
+    stale = []
+    for file in files:
+        key = resultKey(name, file)
+        if key in manifest['results']:
+            continue
+        depend = depends(file)
+        known = previousManifest['results'].get(key)
+        if known is not None and known['depends'] == depend:
+            print("Unchanged, reusing " + name + " from: " + join(args.x4folder, file))
+            manifest['results'][key] = known
+        else:
+            manifest['results'][key] = {'depends': depend}
+            stale.append(file)
+    return stale
+
+# minePass() over the stale files only; returns the result of every file,
+# in order, taking the others from the previous run.
+def mineStale(pool, name, files, stale, extract, patterns, *extra):
+    for file, result in zip(stale, minePass(pool, extract, stale, patterns, *extra)):
+        manifest['results'][resultKey(name, file)]['result'] = result
+    return [manifest['results'][resultKey(name, file)]['result'] for file in files]
+
+def fileHash(path):
+    try:
+        with open(path, 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+    except OSError:
+        return None
+
+# Write data, merged from the results of files in order, to filename as
+# json, unless none of those results changed, no archive was added or
+# removed, and the file still holds what the previous run wrote.
+def writeOutput(filename, data, changed, files):
+    files = [abspath(join(args.x4folder, file)) for file in files]
+    known = previousManifest['outputs'].get(filename)
+    digest = fileHash(filename)
+    if not changed and known is not None and known['files'] == files and digest == known['hash']:
+        print("Unchanged: " + filename)
+    else:
+        with open(filename, "w", encoding='utf-8') as jsonfile:
+            jsonfile.write(json.dumps(data, indent=3, ensure_ascii=False))
+        digest = fileHash(filename)
+    manifest['outputs'][filename] = {'hash': digest, 'files': files}
+
 def processOffsets( xmlstrings ):
     offsets = {}
     count = 0
@@ -85,7 +276,7 @@ def processOffsets( xmlstrings ):
         count += 1
         try:
             print("Checking for offset data in: " + rawxml['name'])
-            root = etree.fromstring(bytes(rawxml['content'], encoding='utf8'))
+            root = parseXml(rawxml)
             connections = root.findall(".//connection[@ref='zones']")
             for conn in connections:
                 position = {'x':0.0, 'y':0.0, 'z':0.0, 'pitch':0.0, 'roll':0.0, 'yaw':0.0}
@@ -120,7 +311,7 @@ def fetchNames( xmlstrings, langid ):
     for rawxml in xmlstrings:
         count +=1
         print("Checking for name-mappings data in: " + rawxml['name'])
-        root = etree.fromstring(bytes(rawxml['content'], encoding='utf8'))
+        root = parseXml(rawxml)
         xmlid = root.get('id')
         if xmlid != langid:
             xmlid = "none" if xmlid == None else xmlid
@@ -152,7 +343,7 @@ def nameSectors( xmlstrings, names):
     for rawxml in xmlstrings:
         count +=1
         print("Checking for sector naming data in: " + rawxml['name'])
-        root = etree.fromstring(bytes(rawxml['content'], encoding='utf8'))
+        root = parseXml(rawxml)
         sectors = root.findall(".//dataset")
         for sector in sectors:
             name = sector.get('macro')
@@ -176,7 +367,7 @@ def processWares(xmlstrings):
     for rawxml in xmlstrings:
         if rawxml['name'] == 'libraries/wares.xml':
             print("Processing wares xml in: " + rawxml['name'])
-            root = etree.fromstring(bytes(rawxml['content'], encoding='utf8'))
+            root = parseXml(rawxml)
             for ware in root.findall('.//ware[@id]'):
                 wid = ware.get('id')
                 vol = ware.get('volume')
@@ -191,7 +382,7 @@ def processBaskets(xmlstrings, wareVolumes):
     for rawxml in xmlstrings:
         if rawxml['name'] == 'libraries/baskets.xml':
             print("Processing baskets xml in: " + rawxml['name'])
-            root = etree.fromstring(bytes(rawxml['content'], encoding='utf8'))
+            root = parseXml(rawxml)
             for basket in root.findall('.//basket[@id]'):
                 bid = basket.get('id')
                 total = 0
@@ -211,7 +402,7 @@ def processShips(xmlstrings, basketVolumes):
     for rawxml in xmlstrings:
         if rawxml['name'] == 'libraries/ships.xml':
             print("Processing ships xml in: " + rawxml['name'])
-            root = etree.fromstring(bytes(rawxml['content'], encoding='utf8'))
+            root = parseXml(rawxml)
             for ship in root.findall('.//ship[@id]'):
                 sid = ship.get('id')
                 basket = ship.find('.//basket')
@@ -236,7 +427,7 @@ def processStorageMacros(xmlstrings):
         if '/macros/' not in name:
             continue
         try:
-            root = etree.fromstring(bytes(rawxml['content'], encoding='utf8'))
+            root = parseXml(rawxml)
         except Exception:
             continue
         for macro in root.findall('.//macro[@class="storage"]'):
@@ -249,56 +440,111 @@ def processStorageMacros(xmlstrings):
                     pass
     return storage
 
-offsets = {}
-names = {}
-sectorNames = {}
-
-offsetFiles += glob.glob(args.x4folder + "/extensions/*/*0[123].cat")
-nameFiles += glob.glob(args.x4folder + "/extensions/*/*0[123].cat")
-nameMappingFiles += glob.glob(args.x4folder + "/extensions/*/*0[123].cat")
-
-for file in offsetFiles:
-    xmlstrings = fetchXmlwithCat(args.x4folder, file)
-    offsets.update(processOffsets( xmlstrings ))
-
-for file in nameFiles:
-   xmlstrings = fetchXmlwithCat(args.x4folder, file)
-   names.update( fetchNames(xmlstrings, args.langid ))
-
-for file in nameMappingFiles:
-   xmlstrings = fetchXmlwithCat(args.x4folder, file)
-   sectorNames.update( nameSectors(xmlstrings, names ))
-
-with open("x4-offsets.json", "w", encoding='utf-8') as jsonfile:
-    jsonfile.write( json.dumps(offsets, indent=3, ensure_ascii=False) )
-
-with open("x4-names.json", "w", encoding='utf-8') as jsonfile:
-    jsonfile.write( json.dumps(sectorNames, indent=3, ensure_ascii=False) )
-
-# Process ware volumes and ship cargo hold sizes from base and DLC libraries
-dataFiles = [ join(args.x4folder, '08.cat') ] + glob.glob(args.x4folder + "/extensions/*/ext_03.cat")
-xmlstrings = []
-for file in dataFiles:
-    xmlstrings += fetchXmlwithCat(args.x4folder, file)
-# Compute ware and basket volumes and default ship hold capacities from libraries
-wareVolumes   = processWares(xmlstrings)
-basketVolumes = processBaskets(xmlstrings, wareVolumes)
-shipHolds     = processShips(xmlstrings, basketVolumes)
-
-# Gather macro definitions (storage macros) to override/add exact cargo hold sizes
-macroCats = [f for f in listdir(args.x4folder) if f.lower().endswith('.cat')]
-macroFiles = [ join(args.x4folder, fn) for fn in macroCats ]
-extdir = join(args.x4folder, 'extensions')
-if isdir(extdir):
-    macroFiles += glob.glob(extdir + '/*/ext_01.cat')
-for file in macroFiles:
-    xmlstrings += fetchXmlwithCat(args.x4folder, file)
-macroHolds = processStorageMacros(xmlstrings)
-# Override library holds with storage macro maxima
-shipHolds.update(macroHolds)
-
-with open("x4-wares.json", "w", encoding='utf-8') as jsonfile:
-    jsonfile.write(json.dumps(wareVolumes,   indent=3, ensure_ascii=False))
-
-with open("x4-ship-holds.json", "w", encoding='utf-8') as jsonfile:
-    jsonfile.write(json.dumps(shipHolds,     indent=3, ensure_ascii=False))
+if __name__ == '__main__':
+    offsets = {}
+    names = {}
+    sectorNames = {}
+
+    offsetFiles += glob.glob(args.x4folder + "/extensions/*/*0[123].cat")
+    nameFiles += glob.glob(args.x4folder + "/extensions/*/*0[123].cat")
+    nameMappingFiles += glob.glob(args.x4folder + "/extensions/*/*0[123].cat")
+
+    # Ware volumes and ship cargo hold sizes come from base and DLC libraries,
+    # exact hold sizes from the storage macros in those archives and in every
+    # other one, later archives overriding earlier ones
+    dataFiles = [ join(args.x4folder, '08.cat') ] + glob.glob(args.x4folder + "/extensions/*/ext_03.cat")
+    libraryPatterns = ['libraries/wares.xml', 'libraries/baskets.xml', 'libraries/ships.xml']
+    macroCats = [f for f in listdir(args.x4folder) if f.lower().endswith('.cat')]
+    macroFiles = dataFiles + [ join(args.x4folder, fn) for fn in macroCats ]
+    extdir = join(args.x4folder, 'extensions')
+    if isdir(extdir):
+        macroFiles += glob.glob(extdir + '/*/ext_01.cat')
+    macroPatterns = ['*/macros/*.xml']
+
+    # Work out which archives changed since the last run.  Sector names are
+    # resolved through the names, so they are mined again whenever those
+    # change, and the library pass is redone if any of its archives did
+    if not args.full:
+        previousManifest = loadManifest(MANIFEST_FILE)
+    nameDepends = hashlib.sha1(' '.join(archiveHash(file) for file in nameFiles).encode()).hexdigest()
+    staleOffsets = staleFiles('offsets', offsetFiles, archiveHash)
+    staleNames = staleFiles('names', nameFiles, lambda file: archiveHash(file) + ' ' + args.langid)
+    staleSectors = staleFiles('sectors', nameMappingFiles, lambda file: archiveHash(file) + ' ' + args.langid + ' ' + nameDepends)
+    libraryDepends = ' '.join(archiveHash(file) for file in dataFiles)
+    staleLibraries = staleFiles('libraries', [''], lambda folder: libraryDepends)
+    staleMacros = staleFiles('macros', macroFiles, archiveHash)
+    if staleLibraries:
+        staleLibraries = dataFiles
+
+    # The pool is started before the passes are planned below, so its workers
+    # never keep parsed documents around
+    pool = None
+    if args.jobs != 1 and (staleOffsets or staleNames or staleSectors or staleMacros):
+        pool = multiprocessing.Pool(args.jobs or None)
+
+    # Several passes read the same archives, so a parsed document is kept only
+    # until the last pass that reads it
+    passes = [
+        passEntries(args.x4folder, staleOffsets),
+        passEntries(args.x4folder, staleNames),
+        passEntries(args.x4folder, staleSectors),
+        passEntries(args.x4folder, staleLibraries, libraryPatterns),
+        passEntries(args.x4folder, staleMacros, macroPatterns),
+    ]
+    shareEntries(passes)
+
+    for result in mineStale(pool, 'offsets', offsetFiles, staleOffsets, processOffsets, ['*.xml']):
+        offsets.update(result)
+    releaseDocuments(set().union(*passes[1:]))
+
+    for result in mineStale(pool, 'names', nameFiles, staleNames, fetchNames, ['*.xml'], args.langid):
+       names.update(result)
+    releaseDocuments(set().union(*passes[2:]))
+
+    for result in mineStale(pool, 'sectors', nameMappingFiles, staleSectors, nameSectors, ['*.xml'], names):
+       sectorNames.update(result)
+    releaseDocuments(set().union(*passes[3:]))
+
+    writeOutput("x4-offsets.json", offsets, staleOffsets, offsetFiles)
+    writeOutput("x4-names.json", sectorNames, staleSectors, nameFiles + nameMappingFiles)
+
+    if staleLibraries:
+        xmlstrings = []
+        for file in dataFiles:
+            xmlstrings += fetchXmlwithCat(args.x4folder, file, libraryPatterns)
+        # Compute ware and basket volumes and default ship hold capacities from libraries
+        wareVolumes   = processWares(xmlstrings)
+        basketVolumes = processBaskets(xmlstrings, wareVolumes)
+        shipHolds     = processShips(xmlstrings, basketVolumes)
+        manifest['results'][resultKey('libraries', '')]['result'] = {'wares': wareVolumes, 'ships': shipHolds}
+    libraries = manifest['results'][resultKey('libraries', '')]['result']
+    wareVolumes = libraries['wares']
+    shipHolds = dict(libraries['ships'])
+    releaseDocuments(passes[4])
+
+    # Gather macro definitions (storage macros) to override/add exact cargo hold sizes
+    macroHolds = {}
+    for result in mineStale(pool, 'macros', macroFiles, staleMacros, processStorageMacros, macroPatterns):
+        macroHolds.update(result)
+    releaseDocuments(set())
+    if pool is not None:
+        pool.close()
+        pool.join()
+    # Override library holds with storage macro maxima
+    shipHolds.update(macroHolds)
+
+    writeOutput("x4-wares.json", wareVolumes, staleLibraries, dataFiles)
+    writeOutput("x4-ship-holds.json", shipHolds, staleLibraries or staleMacros, macroFiles)
+
+    with open(MANIFEST_FILE + ".tmp", "w", encoding='utf-8') as jsonfile:
+        jsonfile.write(json.dumps(manifest, ensure_ascii=False))
+    os.replace(MANIFEST_FILE + ".tmp", MANIFEST_FILE)
+
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    if resource is not None:
+        scale = 1024 * 1024 if sys.platform == 'darwin' else 1024
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        print("Peak memory: %.1f MB" % (peak / scale))
+        if pool is not None:
+            peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+            print("Peak worker memory: %.1f MB" % (peak / scale))
@@ -35,8 +35,28 @@ import re
 import time
 import math
 import heapq
+import bisect
+import hashlib
+import io
+import itertools
+import os
+import queue
+import random
+import threading
+import zlib
+from array import array
 from collections import defaultdict
 
+# Optional faster inflate backends (python-isal, zlib-ng), used in place of
+# the standard gzip module when installed
+try:
+    from isal import igzip as gzip_backend
+except ImportError:
+    try:
+        from zlib_ng import gzip_ng as gzip_backend
+    except ImportError:
+        gzip_backend = gzip
+
 parser = argparse.ArgumentParser()
 parser.add_argument("savefile", help="The savegame you want to analyse")
 parser.add_argument("-o", "--ownerless", help="Display ownerless ship locations", action="store_true")
@@ -55,15 +75,22 @@ parser.add_argument("-q", "--quiet", help="Suppress warnings in interactive mode
 parser.add_argument("-i", "--info", help="information level [1-3]. Default is 1 (sector only)", default='1')
 parser.add_argument("-f", "--factions", help="Display faction relative strengths", action="store_true")
 parser.add_argument("-t", "--trades", help="Display most profitable ware trades. Optional count and max cargo size", nargs='*')
+parser.add_argument("--trade-run", help="Plan a run of chained trades. Optional number of trades (default 3) and max cargo size", nargs='*')
+parser.add_argument("--fleet", help="Assign a trade to every player-owned ship with a cargo hold", action="store_true")
 parser.add_argument("--player", help="Use player location, cargo and credits when ranking trades", action="store_true")
 parser.add_argument("--distance", help="Rank trades by profit per kilometre", action="store_true")
 parser.add_argument("--avoid-illegal-sectors", help="Avoid trades through sectors where the ware is illegal", action="store_true")
 parser.add_argument("--avoid-hostile-sectors", help="Avoid trades through sectors hostile to the player", action="store_true")
+parser.add_argument("--distance-matrix", help="Precompute all gate-to-gate distances before ranking trades", action="store_true")
+parser.add_argument("--no-stream", help="Read the whole savefile into memory before parsing it", action="store_true")
+parser.add_argument("--no-snapshot", help="Do not read or write the snapshot cache stored next to the savefile", action="store_true")
 parser.add_argument("-s", "--shell", help="Starts a python shell to interract with the XML data (read-only)", action="store_true")
 args = parser.parse_args()
+if args.trade_run and args.trade_run[0] != '' and (not args.trade_run[0].isdigit() or int(args.trade_run[0]) < 1):
+    parser.error("--trade-run: the number of trades must be a whole number of 1 or more")
 
 sectors = []
-duplicates = []
+duplicates = {}
 warnings = []
 sectorCodes = {}
 shipCodes = {}
@@ -72,7 +99,9 @@ vaultCodes = {}
 lockboxCodes = {}
 allCodes = {}
 sectorNames = {}
+sectorContents = {}
 allComponents = []
+codeComponents = defaultdict(list)
 allStations = []
 allShips = []
 freeShips = []
@@ -87,6 +116,7 @@ other = []
 ignoredConnections = {}
 sector_zone_offsets = {}
 sector_macros = {}
+position_chains = {}
 stats = {}
 phq = None
 playerLocation = None
@@ -98,6 +128,7 @@ ware_volumes = {}
 ship_hold_sizes = {}
 trade_buyers = {}
 trade_sellers = {}
+trade_index = {}
 gates = []
 sector_gates = defaultdict(list)
 gate_groups = defaultdict(list)
@@ -106,6 +137,12 @@ nav_graph = {}
 station_offset = 0
 path_cache = {}
 path_map_cache = {}
+core_graph = None
+station_attachments = []
+station_nearest_gate = []
+core_distance_rows = {}
+core_prev_rows = {}
+core_sector_floors = {}
 illegal_factions = set()
 illegal_sectors = set()
 illegal_nodes = set()
@@ -119,21 +156,6 @@ if len(sys.argv) < 3:
     print("\nPlease provide at least 1 argument along with the save file\nUse --help for full help\n")
     sys.exit(1)
 
-print("Loading Savefile....")
-start = time.time()
-rawxml = None
-if args.savefile.endswith(".gz"):
-    with gzip.open(args.savefile, 'rb') as f:
-        rawxml = f.read()
-else:
-    with open(args.savefile, 'rb') as f:
-        rawxml = f.read()
-print('Done. Time: %.2f' % (time.time() - start))
-
-if rawxml is None:
-    print("ERROR - Failed to parse savefile")
-    sys.exit(1)
-
 # Load the Offset and Naming maps
 with open("x4-offsets.json", "r") as jsonfile:
     input = jsonfile.read()
@@ -150,56 +172,25 @@ with open("x4-ship-holds.json", "r") as jsonfile:
     ship_hold_sizes = json.load(jsonfile)
 
 # Create a custom parser with optimized settings
+PARSER_OPTIONS = {
+    'remove_blank_text': True,         # Removes blank text nodes
+    'remove_comments': True,           # Ignores comments
+    'remove_pis': True,                # Removes processing instructions
+    'huge_tree': True,                 # Allows larger trees
+    'collect_ids': False,              # Don't collect XML IDs
+    'resolve_entities': False          # Don't resolve entities
+}
 def create_optimized_parser():
     # Create a parser that's optimized for speed
-    parser = etree.XMLParser(
-        remove_blank_text=True,        # Removes blank text nodes
-        remove_comments=True,          # Ignores comments
-        remove_pis=True,               # Removes processing instructions
-        huge_tree=True,                # Allows larger trees
-        collect_ids=False,             # Don't collect XML IDs
-        resolve_entities=False         # Don't resolve entities
-    )
+    parser = etree.XMLParser(**PARSER_OPTIONS)
     return parser
 OPTIMIZED_PARSER = create_optimized_parser()
 
-print("Parsing XML...")
-start = time.time()
-root = etree.fromstring(rawxml, parser=OPTIMIZED_PARSER)
-print('Done. Time: %.2f' % (time.time() - start))
-
-
-# Record player credit balance
-player_info = root.find('.//player')
-if player_info is not None:
-    try:
-        playerCredits = int(player_info.get('money', '0'))
-    except ValueError:
-        playerCredits = 0
-
-
-# Determine the player's relations with all factions and which are hostile
-for rel in root.findall(".//faction[@id='player']/relations/relation"):
-    try:
-        val = float(rel.get('relation', '0'))
-        player_relations[rel.get('faction')] = val
-        if val < -0.25:
-            hostile_factions.add(rel.get('faction'))
-    except ValueError:
-        pass
-
-# Determine which factions enforce illegal wares
-for lic in root.findall(".//licence[@type='station_illegal']"):
-    for fac in lic.get('factions', '').split():
-        illegal_factions.add(fac)
-
 def getDupeObjects(code):
     objects = []
-    if code in duplicates:
-        for obj in allComponents:
-            if obj.get('code') == code:
-                obj.set('location', str(getPosition(obj)))
-                objects += [ obj ]
+    for obj in duplicates.get(code, []):
+        obj.set('location', str(getPosition(obj)))
+        objects += [ obj ]
     return objects
 
 def getSectors(code):
@@ -250,27 +241,80 @@ def getStations(code):
             print("FAILED: Station Not found. Check your speeling ;-)")
     return objects
 
+def newSectorContents():
+    return { 'stations':[], 'ships':[], 'vaults': [], 'flotsam': [], 'lockboxes': [], 'gates': [] }
+
 def getSectorObjects(code):
     if code in sectorNames:
         code = sectorNames[code].get('code')
-    sectorObjects = { 'stations':[], 'ships':[], 'vaults': [], 'flotsam': [] }
-    for station in allStations:
-        if station.get('sector_code') == code:
-            sectorObjects['stations'] += [station]
-    for ship in allShips:
-        if ship.get('sector_code') == code:
-            sectorObjects['ships'] += [ship]
-    for vault in dataVaults:
-        if vault.get('sector_code') == code:
-            sectorObjects['vaults'] += [vault]
-    for floater in flotsam:
-        if floater.get('sector_code') == code:
-            sectorObjects['flotsam'] += [floater]
-    return sectorObjects
+    if code in sectorContents:
+        return sectorContents[code]
+    return newSectorContents()
+
+def proximityDistance(sLocation, oLocation):
+    return math.sqrt(math.pow(sLocation['x'] - oLocation['x'],2) + math.pow(sLocation['z'] - oLocation['z'],2) + math.pow(sLocation['y'] - oLocation['y'],2))
+
+# Per-sector k-d trees of the stations used for proximity, built on first use.
+# Nodes are (entry, axis, left, right) where entry is (location, order, station)
+# and order is the station's place in the sector's station list, which breaks
+# ties the same way the old linear scan did (first station found wins).
+station_trees = {}
+
+def buildStationTree(entries, depth=0):
+    if not entries:
+        return None
+    axis = ['x', 'z', 'y'][depth % 3]
+    entries.sort(key=lambda entry: entry[0][axis])
+    mid = len(entries) // 2
+    return (entries[mid], axis, buildStationTree(entries[:mid], depth + 1), buildStationTree(entries[mid + 1:], depth + 1))
+
+def getStationTree(sectorCode):
+    if sectorCode not in station_trees:
+        entries = []
+        for order, station in enumerate(getSectorObjects(sectorCode)['stations']):
+            if station.get('owner') in ["khaak", "xenon"]:
+                continue
+            entries.append((getPosition(station), order, station))
+        station_trees[sectorCode] = buildStationTree(entries)
+    return station_trees[sectorCode]
+
+def searchStationTree(node, oLocation, k, found):
+    if node is None:
+        return
+    entry, axis, left, right = node
+    sLocation, order, station = entry
+    sdist = proximityDistance(sLocation, oLocation)
+    # found is a min-heap on (-distance, -order), so found[0] is the worst kept
+    candidate = (-sdist, -order, sLocation, station)
+    if len(found) < k:
+        heapq.heappush(found, candidate)
+    elif candidate[:2] > found[0][:2]:
+        heapq.heapreplace(found, candidate)
+    diff = oLocation[axis] - sLocation[axis]
+    near, far = (left, right) if diff < 0 else (right, left)
+    searchStationTree(near, oLocation, k, found)
+    if len(found) < k or abs(diff) <= -found[0][0]:
+        searchStationTree(far, oLocation, k, found)
+
+def findNearestStations(sectorCode, oLocation, k=1):
+    """Return [(distance, station, location)] for the k stations closest to
+    oLocation in the sector, nearest first.  Xenon and Kha'ak stations are
+    not included."""
+    found = []
+    searchStationTree(getStationTree(sectorCode), oLocation, k, found)
+    found.sort(reverse=True)
+    return [(-negdist, station, sLocation) for negdist, _, sLocation, station in found]
+
+def nearestStations(obj, k=1):
+    """Return [(station, distance)] for the k stations closest to obj"""
+    if type(obj) is str:
+        objects = getObjects(obj)
+        if len(objects) > 1:
+            print("WARNING: Duplicate code exists for: " + obj + ". We could be tracking the wrong object")
+        obj = objects[0]
+    return [(station, distance) for distance, station, _ in findNearestStations(obj.get('sector_code'), getPosition(obj), k)]
 
 def getProximity(obj):
-    closest = None
-    distance = 9999999
     infos = []
     if type(obj) is str:
         objects = getObjects(obj)
@@ -278,22 +322,12 @@ def getProximity(obj):
             print("WARNING: Duplicate code exists for: " + obj + ". We could be tracking the wrong object")
         obj = objects[0]
     sectorCode = obj.get('sector_code')
-    sectorObjects = getSectorObjects(sectorCode)
     oLocation = getPosition(obj)
-    for station in sectorObjects['stations']:
-        owner = station.get('owner')
-        if owner in ["khaak", "xenon"]:
-            continue
-        sLocation = getPosition(station)
-        sdist = math.sqrt(math.pow(sLocation['x'] - oLocation['x'],2) + math.pow(sLocation['z'] - oLocation['z'],2) + math.pow(sLocation['y'] - oLocation['y'],2))
-        if closest == None or sdist < distance:
-            closest = station.get('code')
-            distance = sdist
-            infos = buildProximityInfo(oLocation, sLocation, closest, distance)
+    for distance, station, sLocation in findNearestStations(sectorCode, oLocation):
+        infos = buildProximityInfo(oLocation, sLocation, station.get('code'), distance)
     if playerLocation.get('sector_code') == sectorCode:
         pLocation = getPosition(playerLocation)
-        pdist = math.sqrt(math.pow(pLocation['x'] - oLocation['x'],2) + math.pow(pLocation['z'] - oLocation['z'],2) + math.pow(pLocation['y'] - oLocation['y'],2))
-        infos += buildProximityInfo(oLocation, pLocation, "player", pdist)
+        infos += buildProximityInfo(oLocation, pLocation, "player", proximityDistance(pLocation, oLocation))
     return infos
 
 def updateStatsInfo(stats, owner, type, subtype=None):
@@ -316,6 +350,179 @@ def distance_between(p1, p2):
     zd = p1['z'] - p2['z']
     return math.sqrt(xd * xd + yd * yd + zd * zd)
 
+class NavGraph:
+    """Navigation graph packed into compressed sparse row arrays.
+
+    The edges leaving node n are targets[offsets[n]:offsets[n + 1]] with the
+    matching weights, kept in the order they were added so that searches
+    visit neighbours in the same order as the old adjacency lists.  dist and
+    prev are scratch buffers for searches that do not keep their result.
+    """
+
+    def __init__(self, adjacency, size):
+        self.size = size
+        self.offsets = array('i', [0]) * (size + 1)
+        self.targets = array('i')
+        self.weights = array('d')
+        for node in range(size):
+            for nxt, w in adjacency.get(node, []):
+                self.targets.append(nxt)
+                self.weights.append(w)
+            self.offsets[node + 1] = len(self.targets)
+        self.unreached = array('d', [float('inf')]) * size
+        self.no_prev = array('i', [-1]) * size
+        self.dist = array('d', self.unreached)
+        self.prev = array('i', self.no_prev)
+        self.reversed = None
+        self.avoided = None
+        self.landmarks = None
+
+    def edges(self, node):
+        start, end = self.offsets[node], self.offsets[node + 1]
+        return zip(self.targets[start:end], self.weights[start:end])
+
+    def avoid_marks(self):
+        """Return a bytearray with bit i set for the nodes avoided by the
+        i-th entry of variant_avoid_sets.  Reset avoided to None when the
+        avoid sets change.
+        """
+        if self.avoided is None:
+            self.avoided = bytearray(self.size)
+            for i, avoid_set in enumerate(variant_avoid_sets.values()):
+                for node in avoid_set:
+                    if node < self.size:
+                        self.avoided[node] |= 1 << i
+        return self.avoided
+
+    def reverse(self):
+        """Return the graph with every edge reversed, so its targets are
+        the sources of the edges entering each node
+        """
+        if self.reversed is None:
+            incoming = defaultdict(list)
+            for node in range(self.size):
+                for nxt, w in self.edges(node):
+                    incoming[nxt].append((node, w))
+            self.reversed = NavGraph(incoming, self.size)
+        return self.reversed
+
+    def distances(self):
+        """Return a new distance array with every node unreached"""
+        return self.unreached[:]
+
+def dijkstra(graph, start, dist, avoid_set=None, goal=None, prev=None, order=None):
+    """Fill dist (all unreached) with the shortest distances from start.
+
+    Nodes in avoid_set are never entered, except for goal.  When prev is
+    given it receives the predecessor of each reached node, and order
+    receives the nodes in the order their distance became final.
+    """
+    offsets, targets, weights = graph.offsets, graph.targets, graph.weights
+    dist[start] = 0.0
+    queue = [(0.0, start)]
+    while queue:
+        d, node = heapq.heappop(queue)
+        if d > dist[node]:
+            continue
+        if order is not None:
+            order.append(node)
+        for e in range(offsets[node], offsets[node + 1]):
+            nxt = targets[e]
+            if avoid_set and nxt in avoid_set and nxt != goal:
+                continue
+            nd = d + weights[e]
+            if nd < dist[nxt]:
+                dist[nxt] = nd
+                if prev is not None:
+                    prev[nxt] = node
+                heapq.heappush(queue, (nd, nxt))
+    return dist
+
+def dijkstra_variants(graph, start, goal=None, wanted=None):
+    """Search from start once and derive the routing variants from it.
+
+    Returns {variant: (dist, prev)} for each variant in wanted, by default
+    every key of variant_avoid_sets; as in dijkstra, avoided nodes are
+    never entered except for goal.  A node whose unrestricted shortest path
+    crosses no node avoided by a variant keeps its distance in that
+    variant, so only the nodes behind avoided ones are searched again,
+    seeded from the edges that reach them from the nodes that kept their
+    distance.
+    """
+    base = graph.distances()
+    base_prev = array('i', graph.no_prev)
+    order = []
+    dijkstra(graph, start, base, prev=base_prev, order=order)
+    results = {}
+    variants = []
+    for i, (variant, avoid_set) in enumerate(variant_avoid_sets.items()):
+        if wanted is not None and variant not in wanted:
+            continue
+        if avoid_set:
+            variants.append((i, variant, avoid_set))
+        else:
+            results[variant] = (base, base_prev)
+    if not variants:
+        return results
+    # bit i of avoided[n] is set when variant i avoids node n, and of
+    # marks[n] when its shortest path also crosses such a node
+    avoided = bytearray(graph.avoid_marks())
+    avoided[start] = 0
+    if goal is not None:
+        avoided[goal] = 0
+    marks = bytearray(avoided)
+    for node in order[1:]:
+        marks[node] |= marks[base_prev[node]]
+    offsets, targets, weights = graph.offsets, graph.targets, graph.weights
+    rev = graph.reverse()
+    rev_offsets, rev_sources, rev_weights = rev.offsets, rev.targets, rev.weights
+    for i, variant, avoid_set in variants:
+        bit = 1 << i
+        dirty = [node for node in order if marks[node] & bit]
+        if not dirty:
+            results[variant] = (base, base_prev)
+            continue
+        if 2 * len(dirty) > len(order):
+            # Most of the tree is cut off; a fresh, smaller search is cheaper
+            prev = array('i', graph.no_prev)
+            dist = dijkstra(graph, start, graph.distances(), avoid_set, goal, prev)
+            results[variant] = (dist, prev)
+            continue
+        dist = base[:]
+        prev = base_prev[:]
+        for node in dirty:
+            dist[node] = float('inf')
+            prev[node] = -1
+        queue = []
+        for node in dirty:
+            if avoided[node] & bit:
+                continue
+            for e in range(rev_offsets[node], rev_offsets[node + 1]):
+                src = rev_sources[e]
+                if marks[src] & bit:
+                    continue
+                nd = dist[src] + rev_weights[e]
+                if nd < dist[node]:
+                    dist[node] = nd
+                    prev[node] = src
+            if math.isfinite(dist[node]):
+                heapq.heappush(queue, (dist[node], node))
+        while queue:
+            d, node = heapq.heappop(queue)
+            if d > dist[node]:
+                continue
+            for e in range(offsets[node], offsets[node + 1]):
+                nxt = targets[e]
+                if not marks[nxt] & bit or avoided[nxt] & bit:
+                    continue
+                nd = d + weights[e]
+                if nd < dist[nxt]:
+                    dist[nxt] = nd
+                    prev[nxt] = node
+                    heapq.heappush(queue, (nd, nxt))
+        results[variant] = (dist, prev)
+    return results
+
 def build_navigation_graph():
     global path_cache
     station_offset = len(gates)
@@ -351,132 +558,369 @@ def build_navigation_graph():
             d = distance_between(station['pos'], gates[gidx]['pos'])
             graph[node].append((gidx, d))
             graph[gidx].append((node, d))
-    return graph, station_offset
+    return NavGraph(graph, station_offset + len(stations)), station_offset
 
 def shortest_path_distance(graph, start, goal, avoid_nodes=None):
     global path_cache, path_map_cache
     if avoid_nodes:
-        # Run Dijkstra without caching when avoiding nodes
-        dist_map = {start: 0.0}
-        queue = [(0.0, start)]
-        while queue:
-            dist, node = heapq.heappop(queue)
-            if dist > dist_map.get(node, float('inf')):
-                continue
-            for nxt, w in graph.get(node, []):
-                if nxt in avoid_nodes and nxt != goal:
-                    continue
-                nd = dist + w
-                if nd < dist_map.get(nxt, float('inf')):
-                    dist_map[nxt] = nd
-                    heapq.heappush(queue, (nd, nxt))
-        return dist_map.get(goal, float('inf'))
+        # Search just this pair without caching when avoiding nodes
+        point_search(graph, start, goal, avoid_nodes)
+        return graph.dist[goal]
 
     key = (start, goal)
     if key in path_cache:
         return path_cache[key]
 
     if start in path_map_cache:
-        dist = path_map_cache[start].get(goal, float('inf'))
+        dist = path_map_cache[start][goal]
         path_cache[key] = dist
         path_cache[(goal, start)] = dist
         return dist
 
-    dist_map = {start: 0.0}
-    queue = [(0.0, start)]
-    while queue:
-        dist, node = heapq.heappop(queue)
-        if dist > dist_map.get(node, float('inf')):
-            continue
-        for nxt, w in graph.get(node, []):
-            nd = dist + w
-            if nd < dist_map.get(nxt, float('inf')):
-                dist_map[nxt] = nd
-                heapq.heappush(queue, (nd, nxt))
+    dist_map = dijkstra(graph, start, graph.distances())
     path_map_cache[start] = dist_map
-    dist = dist_map.get(goal, float('inf'))
+    dist = dist_map[goal]
     path_cache[key] = dist
     path_cache[(goal, start)] = dist
     return dist
 
+def variant_search(graph, start, variant):
+    """Return the cached (dist_map, prev_map) arrays from start for a
+    variant.  On a miss one search fills the caches of every variant in
+    routing_variants.
+    """
+    if start not in path_map_cache_variants[variant]:
+        routing_variants.add(variant)
+        wanted = [v for v in routing_variants if start not in path_map_cache_variants[v]]
+        for v, (dist_map, prev_map) in dijkstra_variants(graph, start, wanted=wanted).items():
+            path_map_cache_variants[v][start] = dist_map
+            path_prev_cache_variants[v][start] = prev_map
+    return path_map_cache_variants[variant][start], path_prev_cache_variants[variant][start]
+
+def reach_goal(graph, start, goal, dist_map, prev_map, avoid_set):
+    """Return (distance, predecessor) of goal in a search from start.
+
+    Avoided nodes are skipped except for the goal, so an avoided goal is
+    reached over its best edge from a node the search did reach.
+    """
+    if goal == start or goal not in avoid_set:
+        return dist_map[goal], prev_map[goal]
+    rev = graph.reverse()
+    rev_offsets, rev_sources, rev_weights = rev.offsets, rev.targets, rev.weights
+    best = float('inf')
+    via = -1
+    for e in range(rev_offsets[goal], rev_offsets[goal + 1]):
+        src = rev_sources[e]
+        nd = dist_map[src] + rev_weights[e]
+        if nd < best:
+            best = nd
+            via = src
+    return best, via
+
 def shortest_path_distance_variant(graph, start, goal, variant):
     """Compute shortest path distance using per-variant caches.
 
     variant can be 'none', 'hostile', 'illegal', or 'both'.
-    Distances are cached for each start node per variant.  Nodes in
-    variant_avoid_sets[variant] are skipped except for the goal.
+    Distances are cached for each start node per variant, and the first
+    query from a start fills the maps of all variants from one search.
+    Nodes in variant_avoid_sets[variant] are skipped except for the goal.
     """
-    avoid_set = variant_avoid_sets.get(variant, set())
     key = (start, goal)
     cache = path_cache_variants[variant]
     if key in cache:
         return cache[key]
-    dist_map_cache = path_map_cache_variants[variant]
-    if start in dist_map_cache:
-        dist = dist_map_cache[start].get(goal, float('inf'))
-        cache[key] = dist
-        cache[(goal, start)] = dist
-        return dist
-    dist_map = {start: 0.0}
-    queue = [(0.0, start)]
-    while queue:
-        dist, node = heapq.heappop(queue)
-        if dist > dist_map.get(node, float('inf')):
-            continue
-        for nxt, w in graph.get(node, []):
-            if nxt in avoid_set and nxt != goal:
-                continue
-            nd = dist + w
-            if nd < dist_map.get(nxt, float('inf')):
-                dist_map[nxt] = nd
-                heapq.heappush(queue, (nd, nxt))
-    dist_map_cache[start] = dist_map
-    dist = dist_map.get(goal, float('inf'))
+    dist_map, prev_map = variant_search(graph, start, variant)
+    dist, _ = reach_goal(graph, start, goal, dist_map, prev_map, variant_avoid_sets.get(variant, set()))
     cache[key] = dist
     cache[(goal, start)] = dist
     return dist
 
-# New helper functions to compute actual paths (routes) rather than just
-# distances.  These functions mirror the shortest_path_distance* functions
-# above but also record the predecessors so that the path can be reconstructed.
-def shortest_path_route(graph, start, goal, avoid_nodes=None):
-    """Return a list of node indices representing the shortest path from
-    start to goal.  If no path exists, an empty list is returned.
+# Two-level routing.  Stations only connect to the gates of their own sector,
+# so routes between stations are answered on the small gate-only core graph
+# and the stations are attached at either end.  Passing through a station
+# never beats the direct edge between two gates of the same sector, so the
+# core graph loses no routes.
+def build_core_graph(graph, station_offset):
+    """Return the gate-only core of the navigation graph and, for each
+    station, the list of (gate, distance) attachments to its sector's gates.
+    """
+    adjacency = {}
+    for node in range(station_offset):
+        adjacency[node] = [(nxt, w) for nxt, w in graph.edges(node) if nxt < station_offset]
+    attachments = [list(graph.edges(station_offset + si)) for si in range(graph.size - station_offset)]
+    return NavGraph(adjacency, station_offset), attachments
+
+def core_distances(gidx, variant):
+    """Return the core distances from a gate for a variant, indexed by gate.
+
+    Rows are computed on first use and cached per variant.  As with
+    shortest_path_distance_variant the start gate is always expanded while
+    other gates in variant_avoid_sets[variant] are left unreachable.
+    """
+    rows = core_distance_rows.setdefault(variant, {})
+    if gidx not in rows:
+        # One search fills the rows of every variant in routing_variants
+        routing_variants.add(variant)
+        wanted = [v for v in routing_variants if gidx not in core_distance_rows.setdefault(v, {})]
+        for v, (row, prev) in dijkstra_variants(core_graph, gidx, wanted=wanted).items():
+            core_distance_rows[v][gidx] = row
+            core_prev_rows.setdefault(v, {})[gidx] = prev
+    return rows[gidx]
+
+def core_route(start, goal, variant):
+    """Return the gates on the core route from start to goal, read back
+    from the predecessors cached with start's core distances.
+    """
+    core_distances(start, variant)
+    prev = core_prev_rows[variant][start]
+    route = [goal]
+    while route[-1] != start and prev[route[-1]] >= 0:
+        route.append(prev[route[-1]])
+    route.reverse()
+    return route
+
+def precompute_core_distances(variant):
+    """Fill in the core distances between every pair of gates for a variant"""
+    for gidx in range(core_graph.size):
+        core_distances(gidx, variant)
+
+def gate_to_station_link(gidx, station_idx, variant):
+    """Return (distance, arrival gate) from a gate to a station through
+    the core graph
+    """
+    row = core_distances(gidx, variant)
+    best = float('inf')
+    arrival = None
+    for gb, db in station_attachments[station_idx]:
+        total = row[gb] + db
+        if total < best:
+            best = total
+            arrival = gb
+    return best, arrival
 
-    avoid_nodes can be a set of nodes to skip (except for the goal).
+def gate_to_station_distance_variant(gidx, station_idx, variant):
+    """Distance from a gate to a station through the core graph"""
+    return gate_to_station_link(gidx, station_idx, variant)[0]
+
+def station_link(start_idx, goal_idx, variant):
+    """Return (distance, departure gate, arrival gate) between two stations
+    through the core graph.
+
+    The route leaves through one of the start's sector gates and arrives
+    through one of the goal's.
     """
-    # Dijkstra search with predecessor tracking
-    dist_map = {start: 0.0}
-    prev_map = {}
-    queue = [(0.0, start)]
-    visited = set()
+    avoid_set = variant_avoid_sets.get(variant, set())
+    goal_gates = station_attachments[goal_idx]
+    best = float('inf')
+    departure = arrival = None
+    for gs, ds in station_attachments[start_idx]:
+        if gs in avoid_set:
+            continue
+        row = core_distances(gs, variant)
+        for gb, db in goal_gates:
+            total = ds + row[gb] + db
+            if total < best:
+                best = total
+                departure = gs
+                arrival = gb
+    return best, departure, arrival
+
+def station_distance_variant(start_idx, goal_idx, variant):
+    """Distance between two stations through the core graph"""
+    if start_idx == goal_idx:
+        return 0.0
+    return station_link(start_idx, goal_idx, variant)[0]
+
+def core_gates_floor(sources, targets):
+    """Return a lower bound on the core distance from any gate in sources
+    to any gate in targets, or inf when none of them can be reached.
+    """
+    if not sources or not targets:
+        # a sector without gates cannot be reached through the core graph
+        return float('inf')
+    if core_graph.landmarks is None:
+        core_graph.landmarks = build_landmarks(core_graph)
+    best = 0.0
+    for to_nodes, from_nodes in core_graph.landmarks:
+        # d(g, h) >= d(L, h) - d(L, g) >= d(g, L) - d(h, L) for every pair
+        ahead = min(to_nodes[h] for h in targets) - max(to_nodes[g] for g in sources)
+        behind = min(from_nodes[g] for g in sources) - max(from_nodes[h] for h in targets)
+        if ahead > best:
+            best = ahead
+        if behind > best:
+            best = behind
+    return best
+
+def sector_distance_floor(start_sector, goal_sector):
+    """Return a lower bound on the core distance between the gates of two
+    sectors that holds for every variant, or inf when they are not
+    connected at all.  Bounds are cached per pair of sectors.
+    """
+    if start_sector == goal_sector:
+        return 0.0
+    key = (start_sector, goal_sector)
+    floor = core_sector_floors.get(key)
+    if floor is None:
+        floor = core_gates_floor(sector_gates[start_sector], sector_gates[goal_sector])
+        core_sector_floors[key] = floor
+    return floor
+
+def station_route_variant(start_idx, goal_idx, variant):
+    """Return the route between two stations as a list of node indices,
+    built from the cached core routes without searching the full graph.
+    """
+    start = station_offset + start_idx
+    goal = station_offset + goal_idx
+    if start_idx == goal_idx:
+        return [start]
+    dist, departure, arrival = station_link(start_idx, goal_idx, variant)
+    if not math.isfinite(dist):
+        return []
+    return [start] + core_route(departure, arrival, variant) + [goal]
+
+def gate_to_station_route_variant(gidx, station_idx, variant):
+    """Return the route from a gate to a station as a list of node indices"""
+    dist, arrival = gate_to_station_link(gidx, station_idx, variant)
+    if not math.isfinite(dist):
+        return []
+    return core_route(gidx, arrival, variant) + [station_offset + station_idx]
+
+# Single point-to-point queries are answered with A* guided by landmark
+# (ALT) lower bounds.  Positions are local to each sector so they give no
+# usable heuristic; instead, by the triangle inequality, the distances to
+# and from a few landmarks bound the distance that is left to the goal.
+# Avoiding nodes only makes routes longer, so the bounds hold for any avoid
+# set.
+LANDMARK_COUNT = 8
+
+def build_landmarks(graph, count=LANDMARK_COUNT):
+    """Pick landmarks spread over the graph, each as far as possible from
+    those already picked, and return a list of (from, to) distance arrays
+    holding each landmark's distance to and from every node.
+    """
+    landmarks = []
+    if graph.size == 0:
+        return landmarks
+    rev = graph.reverse()
+    spread = dijkstra(graph, 0, graph.distances())
+    while len(landmarks) < count:
+        # the reachable node furthest from the landmarks picked so far
+        far = max(range(graph.size), key=lambda n: spread[n] if math.isfinite(spread[n]) else -1.0)
+        if not math.isfinite(spread[far]) or spread[far] == 0.0:
+            break
+        to_nodes = dijkstra(graph, far, graph.distances())
+        from_nodes = dijkstra(rev, far, rev.distances())
+        landmarks.append((to_nodes, from_nodes))
+        if len(landmarks) == 1:
+            spread = array('d', to_nodes)
+        else:
+            spread = array('d', map(min, spread, to_nodes))
+    return landmarks
+
+def landmark_bound(graph, goal):
+    """Return a function giving a lower bound on the distance from a node
+    to goal, or inf when goal cannot be reached from the node at all.
+    """
+    if graph.landmarks is None:
+        graph.landmarks = build_landmarks(graph)
+    terms = [(to_nodes, to_nodes[goal], from_nodes, from_nodes[goal]) for to_nodes, from_nodes in graph.landmarks]
+    def bound(node):
+        best = 0.0
+        for to_nodes, to_goal, from_nodes, from_goal in terms:
+            # d(node, goal) >= d(L, goal) - d(L, node)
+            #               >= d(node, L) - d(goal, L)
+            ahead = to_goal - to_nodes[node]
+            behind = from_nodes[node] - from_goal
+            if ahead > best:
+                best = ahead
+            if behind > best:
+                best = behind
+        return best
+    return bound
+
+def point_search(graph, start, goal, avoid_nodes=None, use_landmarks=True):
+    """Search from start until goal is settled and return the number of
+    nodes expanded.  Distances and predecessors are left in graph.dist and
+    graph.prev.
+
+    With use_landmarks this is A* guided by landmark_bound, otherwise plain
+    Dijkstra.  avoid_nodes can be a set of nodes to skip (except the goal).
+    """
+    offsets, targets, weights = graph.offsets, graph.targets, graph.weights
+    bound = landmark_bound(graph, goal) if use_landmarks else None
+    dist_map = graph.dist
+    dist_map[:] = graph.unreached
+    prev_map = graph.prev
+    prev_map[:] = graph.no_prev
+    dist_map[start] = 0.0
+    queue = [(bound(start) if bound else 0.0, 0.0, start)]
+    expanded = 0
     while queue:
-        dist, node = heapq.heappop(queue)
-        if node in visited:
+        _, dist, node = heapq.heappop(queue)
+        if dist > dist_map[node]:
             continue
-        visited.add(node)
+        expanded += 1
         if node == goal:
             break
-        if dist > dist_map.get(node, float('inf')):
-            continue
-        for nxt, w in graph.get(node, []):
+        for e in range(offsets[node], offsets[node + 1]):
+            nxt = targets[e]
             # Skip avoided nodes unless it's the goal
             if avoid_nodes and nxt in avoid_nodes and nxt != goal:
                 continue
-            nd = dist + w
-            if nd < dist_map.get(nxt, float('inf')):
+            nd = dist + weights[e]
+            if nd < dist_map[nxt]:
+                estimate = nd + bound(nxt) if bound else nd
+                if not math.isfinite(estimate):
+                    continue
                 dist_map[nxt] = nd
                 prev_map[nxt] = node
-                heapq.heappush(queue, (nd, nxt))
+                heapq.heappush(queue, (estimate, nd, nxt))
+    return expanded
+
+def benchmarkRouteSearch(count=100, avoid_nodes=None):
+    """Compare node expansions of plain Dijkstra and landmark A* on random
+    station to station queries
+    """
+    rng = random.Random(0)
+    nodes = range(station_offset, nav_graph.size) if nav_graph.size > station_offset else range(nav_graph.size)
+    pairs = [(rng.choice(nodes), rng.choice(nodes)) for _ in range(count)]
+    if nav_graph.landmarks is None:
+        startTime = time.time()
+        landmark_bound(nav_graph, 0)
+        print("Landmarks: %d, built in %.2fs" % (len(nav_graph.landmarks), time.time() - startTime))
+    results = {}
+    for label, use_landmarks in [("Dijkstra", False), ("A*", True)]:
+        startTime = time.time()
+        expanded = 0
+        results[label] = []
+        for start, goal in pairs:
+            expanded += point_search(nav_graph, start, goal, avoid_nodes, use_landmarks)
+            results[label] += [nav_graph.dist[goal]]
+        print("%-9s %d queries, %d nodes expanded (%.1f per query of %d), %.2fs" % (label + ":", count, expanded, expanded / max(count, 1), nav_graph.size, time.time() - startTime))
+    mismatches = sum(1 for a, b in zip(results["Dijkstra"], results["A*"]) if a != b and not math.isclose(a, b))
+    print("Distance mismatches: %d" % mismatches)
+
+# New helper functions to compute actual paths (routes) rather than just
+# distances.  These functions mirror the shortest_path_distance* functions
+# above but also record the predecessors so that the path can be reconstructed.
+def shortest_path_route(graph, start, goal, avoid_nodes=None):
+    """Return a list of node indices representing the shortest path from
+    start to goal.  If no path exists, an empty list is returned.
+
+    avoid_nodes can be a set of nodes to skip (except for the goal).
+    """
+    point_search(graph, start, goal, avoid_nodes)
+    dist_map = graph.dist
+    prev_map = graph.prev
     # Reconstruct path
-    if goal not in dist_map:
+    if not math.isfinite(dist_map[goal]):
         return []
     path = []
     cur = goal
     while cur != start:
         path.append(cur)
         # Guard against missing predecessor (should not happen)
-        if cur not in prev_map:
+        if prev_map[cur] < 0:
             break
         cur = prev_map[cur]
     path.append(start)
@@ -484,9 +928,28 @@ def shortest_path_route(graph, start, goal, avoid_nodes=None):
     return path
 
 def shortest_path_route_variant(graph, start, goal, variant):
-    """Return a route list using the variant-specific avoid sets."""
-    avoid_set = variant_avoid_sets.get(variant, set())
-    return shortest_path_route(graph, start, goal, avoid_set)
+    """Return a route list using the variant-specific avoid sets.
+
+    The route is read back from the predecessors cached with the start's
+    distance map, so routes from the same start only search once.
+    """
+    dist_map, prev_map = variant_search(graph, start, variant)
+    dist, via = reach_goal(graph, start, goal, dist_map, prev_map, variant_avoid_sets.get(variant, set()))
+    if not math.isfinite(dist):
+        return []
+    if goal == start:
+        return [start]
+    path = [goal]
+    cur = via
+    while cur != start:
+        # Guard against missing predecessor (should not happen)
+        if cur < 0:
+            break
+        path.append(cur)
+        cur = prev_map[cur]
+    path.append(start)
+    path.reverse()
+    return path
 
 def route_to_sector_names(route):
     """Convert a route of gate/station node indices into a list of sector names.
@@ -522,12 +985,7 @@ def distance_from_point_to_station_variant(pos, sector_code, station_idx, varian
     best = distance_between(pos, station['pos']) if sector_code == station['sector_code'] else float('inf')
     for gidx in sector_gates.get(sector_code, []):
         start_dist = distance_between(pos, gates[gidx]['pos'])
-        d = shortest_path_distance_variant(
-            graph=nav_graph,
-            start=gidx,
-            goal=station_offset + station_idx,
-            variant=variant
-        )
+        d = gate_to_station_distance_variant(gidx, station_idx, variant)
         if not math.isfinite(d):
             continue
         total = start_dist + d
@@ -549,20 +1007,156 @@ def route_from_point_to_station_variant(pos, sector_code, station_idx, variant):
     best_route = [station_offset + station_idx] if sector_code == station['sector_code'] else []
     for gidx in sector_gates.get(sector_code, []):
         start_dist = distance_between(pos, gates[gidx]['pos'])
-        d = shortest_path_distance_variant(
-            graph=nav_graph,
-            start=gidx,
-            goal=station_offset + station_idx,
-            variant=variant
-        )
+        d = gate_to_station_distance_variant(gidx, station_idx, variant)
         if not math.isfinite(d):
             continue
         total = start_dist + d
         if total < best:
             best = total
-            best_route = [gidx] + shortest_path_route_variant(nav_graph, gidx, station_offset + station_idx, variant)
+            best_route = [gidx] + gate_to_station_route_variant(gidx, station_idx, variant)
     return best_route
 
+def multi_source_dijkstra(graph, seeds, avoid_set=None):
+    """Return the distances from the nearest of several start nodes, given
+    as (node, initial distance) seeds.
+
+    As for dijkstra, nodes in avoid_set are never entered, but every seed
+    starts at its own distance.
+    """
+    offsets, targets, weights = graph.offsets, graph.targets, graph.weights
+    dist = graph.distances()
+    queue = []
+    for node, d in seeds:
+        if d < dist[node]:
+            dist[node] = d
+            queue.append((d, node))
+    heapq.heapify(queue)
+    while queue:
+        d, node = heapq.heappop(queue)
+        if d > dist[node]:
+            continue
+        for e in range(offsets[node], offsets[node + 1]):
+            nxt = targets[e]
+            if avoid_set and nxt in avoid_set:
+                continue
+            nd = d + weights[e]
+            if nd < dist[nxt]:
+                dist[nxt] = nd
+                heapq.heappush(queue, (nd, nxt))
+    return dist
+
+def station_distances_from_gates(gate_dist):
+    """Extend core gate distances to an array of distances to every station"""
+    return array('d', [min([gate_dist[g] + d for g, d in links], default=float('inf'))
+                       for links in station_attachments])
+
+def distances_from_point_variant(pos, sector_code, variant):
+    """Return an array with distance_from_point_to_station_variant for
+    every station, from one search seeded with every gate of the point's
+    sector at its straight-line distance.
+    """
+    seeds = [(gidx, distance_between(pos, gates[gidx]['pos'])) for gidx in sector_gates.get(sector_code, [])]
+    dist = station_distances_from_gates(multi_source_dijkstra(core_graph, seeds, variant_avoid_sets.get(variant)))
+    for si, station in enumerate(stations):
+        if station['sector_code'] == sector_code:
+            dist[si] = min(dist[si], distance_between(pos, station['pos']))
+    return dist
+
+def distances_from_station_variant(station_idx, variant):
+    """Return an array with station_distance_variant from a station to every
+    station, from one search seeded with the station's gate attachments.
+    """
+    avoid_set = variant_avoid_sets.get(variant, set())
+    seeds = [(g, d) for g, d in station_attachments[station_idx] if g not in avoid_set]
+    dist = station_distances_from_gates(multi_source_dijkstra(core_graph, seeds, avoid_set))
+    dist[station_idx] = 0.0
+    return dist
+
+def sectorNodes(codes):
+    """Return the gate and station nodes of the navigation graph inside
+    the sectors with the given codes
+    """
+    nodes = {gidx for gidx, gate in enumerate(gates) if gate['sector_code'] in codes}
+    nodes.update(station_offset + si for si, station in enumerate(stations) if station['sector_code'] in codes)
+    return nodes
+
+def invalidate_rows(graph, rows, prev_rows, added, removed):
+    """Drop the cached search rows that nodes newly added to or removed
+    from an avoid set can change.
+
+    A row changes when it reached a node that is now avoided, or when a
+    node that is no longer avoided has an edge from a node it reached.
+    The start node of a row is always expanded, so its own status does
+    not matter.
+    """
+    added = [n for n in added if n < graph.size]
+    removed = [n for n in removed if n < graph.size]
+    rev = graph.reverse()
+    for start in list(rows):
+        row = rows[start]
+        stale = any(n != start and math.isfinite(row[n]) for n in added)
+        if not stale:
+            stale = any(n != start and math.isfinite(row[rev.targets[e]])
+                        for n in removed for e in range(rev.offsets[n], rev.offsets[n + 1]))
+        if stale:
+            del rows[start]
+            prev_rows.pop(start, None)
+
+def updateAvoidSets():
+    """Rebuild variant_avoid_sets from hostile_nodes and illegal_nodes and
+    invalidate only the cached searches the changed nodes can affect
+    """
+    updated = {
+        'none': set(),
+        'hostile': set(hostile_nodes),
+        'illegal': set(illegal_nodes),
+        'both': hostile_nodes | illegal_nodes,
+    }
+    for variant, nodes in updated.items():
+        added = nodes - variant_avoid_sets[variant]
+        removed = variant_avoid_sets[variant] - nodes
+        variant_avoid_sets[variant] = nodes
+        if not added and not removed:
+            continue
+        invalidate_rows(core_graph, core_distance_rows.get(variant, {}), core_prev_rows.get(variant, {}), added, removed)
+        invalidate_rows(nav_graph, path_map_cache_variants[variant], path_prev_cache_variants[variant], added, removed)
+        path_cache_variants[variant].clear()
+    # the avoid bitmasks are rebuilt on the next search
+    nav_graph.avoided = None
+    core_graph.avoided = None
+
+def setFactionHostile(faction, hostile=True):
+    """Mark a faction as hostile (or not) for routing and update the avoid
+    sets of the sectors it owns.  Returns the codes of those sectors.
+    """
+    if hostile:
+        hostile_factions.add(faction)
+    else:
+        hostile_factions.discard(faction)
+    codes = {sector.get('code') for sector in sectors if sector.get('owner') == faction}
+    nodes = sectorNodes(codes)
+    if hostile:
+        hostile_sectors.update(codes)
+        hostile_nodes.update(nodes)
+    else:
+        hostile_sectors.difference_update(codes)
+        hostile_nodes.difference_update(nodes)
+    updateAvoidSets()
+    return codes
+
+def setSectorIllegal(sectorCode, illegal=True):
+    """Mark a sector as one where illegal wares are (or are not) policed
+    and update the avoid sets
+    """
+    nodes = sectorNodes({sectorCode})
+    if illegal:
+        illegal_sectors.add(sectorCode)
+        illegal_nodes.update(nodes)
+    else:
+        illegal_sectors.discard(sectorCode)
+        illegal_nodes.difference_update(nodes)
+    updateAvoidSets()
+
 def distance_from_point_to_station(pos, sector_code, station_idx, avoid_nodes=None):
     """Return the shortest distance from an arbitrary point to a station.
 
@@ -585,97 +1179,353 @@ def distance_from_point_to_station(pos, sector_code, station_idx, avoid_nodes=No
             best = total
     return best
 
+def tradeOfferUsable(offer):
+    """True if the player can deal with a trade offer at all"""
+    if offer.get('virtual'):
+        return False
+    if player_relations.get(offer.get('owner', ''), 0) < 0:
+        return False
+    return offer['amount'] != 0
+
+def tradeVariant(sell, buy, avoid_illegal=False, avoid_hostile=False):
+    """Return the routing variant for a trade between two offers"""
+    is_illegal_trade = sell.get('illegal') or buy.get('illegal')
+    if avoid_hostile and avoid_illegal and is_illegal_trade:
+        return 'both'
+    if avoid_illegal and is_illegal_trade:
+        return 'illegal'
+    if avoid_hostile:
+        return 'hostile'
+    return 'none'
+
+def tradeIndex(ware):
+    """Return (sellers, by_price, prices, buying, closest) for a ware: its
+    usable sellers, the indexes of its usable buyers in trade_buyers[ware]
+    sorted by price, those prices, the set of buying stations and the
+    nearest gate attachment of any of them.  Cached in trade_index, which
+    must be cleared when offers or player relations change.
+    """
+    index = trade_index.get(ware)
+    if index is None:
+        sellers = [sell for sell in trade_sellers.get(ware, []) if tradeOfferUsable(sell)]
+        buyers = trade_buyers.get(ware, [])
+        by_price = [i for i, buy in enumerate(buyers) if tradeOfferUsable(buy)]
+        by_price.sort(key=lambda i: buyers[i]['price'])
+        prices = [buyers[i]['price'] for i in by_price]
+        buying = {buyers[i]['index'] for i in by_price}
+        closest = min((station_nearest_gate[idx] for idx in buying), default=float('inf'))
+        index = (sellers, by_price, prices, buying, closest)
+        trade_index[ware] = index
+    return index
+
 def getProfitableTrades(limit=5, max_cargo=None, use_distance=False,
                         origin=None, cargo_limit=None, credits=None,
-                        avoid_illegal=False, avoid_hostile=False):
-    heap = []
-    counter = 0  # tie-breaker for heap items
-    for ware, sellers in trade_sellers.items():
+                        avoid_illegal=False, avoid_hostile=False,
+                        origin_station=None, used=None, origin_sector=None):
+    """Return the best limit trades, best first.
+
+    Trades are ranked branch and bound: every seller and then every pair
+    gets a cheap upper bound on its score, the profit it could make divided
+    by a lower bound on the distance when scoring by distance.  Sellers are
+    expanded into their pairs and pairs are routed in order of that bound
+    until no remaining bound can beat the worst of the current top trades,
+    so only a handful of pairs ever need a path query.  Trades with the
+    same score keep the order they were found in.
+
+    origin_station starts the player leg at a station instead of origin,
+    origin_sector is the sector of origin when it is not the player's, and
+    used maps id(offer) to the amount already taken from an offer.
+    """
+    if limit <= 0:
+        return []
+    if origin_sector is None and playerLocation is not None:
+        origin_sector = playerLocation.get('sector_code')
+    # The player's leg to every station, from one search.  Avoid-hostile
+    # sectors apply to the player path; illegal sectors do not.
+    player_variant = 'hostile' if avoid_hostile else 'none'
+    if origin_station is not None:
+        player_legs = distances_from_station_variant(origin_station, player_variant)
+    elif origin is not None:
+        player_legs = distances_from_point_variant(origin, origin_sector, player_variant)
+    else:
+        player_legs = array('d', [0.0]) * len(stations)
+
+    def available(offer):
+        return offer['amount'] - used.get(id(offer), 0) if used else offer['amount']
+
+    def quantity(sell, amount, volume):
+        qty = min(available(sell), amount)
+        if max_cargo is not None:
+            qty = min(qty, max_cargo // volume)
+        if cargo_limit is not None:
+            qty = min(qty, cargo_limit // volume)
+        if credits is not None and sell['price'] > 0:
+            qty = min(qty, int(credits // sell['price']))
+        return qty
+
+    def distance_bound(profit, least):
+        # shaved a little so rounding can never lift the bound above the
+        # real score
+        least *= 0.999999
+        return profit / (least / 1000.0) if least > 0 else float('inf')
+
+    # Any route between two stations pays the nearest gate attachment at
+    # both ends plus the sector_distance_floor in between; avoiding nodes
+    # only makes routes longer.
+    nearest = station_nearest_gate
+
+    # Candidates are (-bound, seller, pair, ware, sell, buy, qty) with the
+    # seller and pair numbers in the order trades are found.  Pair 0 stands
+    # for a seller that is not expanded yet and carries its buyers instead.
+    candidates = []
+    for ware in trade_sellers:
         buyers = trade_buyers.get(ware)
         if not buyers:
             continue
+        # Only the usable offers are indexed, the buyers by price so each
+        # seller only visits the buyers paying more than it asks, still in
+        # their original order.
+        sellers, by_price, prices, buying, closest_buyer = tradeIndex(ware)
+        if not by_price:
+            continue
+        volume = ware_volumes.get(ware, 1)
         for sell in sellers:
-            for buy in buyers:
-                # Skip trades that are not available to the player
-                if sell.get('virtual') or buy.get('virtual'):
-                    continue
-                if player_relations.get(sell.get('owner', ''), 0) < 0:
-                    continue
-                if player_relations.get(buy.get('owner', ''), 0) < 0:
-                    continue
-                is_illegal_trade = sell.get('illegal') or buy.get('illegal')
-                # Select which avoidance variant to use based on flags.
-                if avoid_hostile and avoid_illegal and is_illegal_trade:
-                    variant = 'both'
-                elif avoid_illegal and is_illegal_trade:
-                    variant = 'illegal'
-                elif avoid_hostile:
-                    variant = 'hostile'
+            first = bisect.bisect_right(prices, sell['price'])
+            if first == len(prices):
+                continue
+            qty = quantity(sell, available(sell), volume)
+            if qty <= 0:
+                continue
+            bound = (prices[-1] - sell['price']) * qty
+            # Sellers the player cannot reach are no use at any price
+            player_leg = player_legs[sell['index']]
+            if not math.isfinite(player_leg):
+                continue
+            if use_distance:
+                if sell['index'] in buying:
+                    bound = distance_bound(bound, player_leg)
                 else:
-                    variant = 'none'
-                if buy['price'] <= sell['price'] or sell['amount'] == 0 or buy['amount'] == 0:
-                    continue
-                qty = min(sell['amount'], buy['amount'])
-                volume = ware_volumes.get(ware, 1)
-                if max_cargo is not None:
-                    qty = min(qty, max_cargo // volume)
-                if cargo_limit is not None:
-                    qty = min(qty, cargo_limit // volume)
-                if credits is not None and sell['price'] > 0:
-                    qty = min(qty, int(credits // sell['price']))
+                    bound = distance_bound(bound, player_leg + nearest[sell['index']] + closest_buyer)
+            candidates.append((-bound, len(candidates), 0, ware, sell, None,
+                               (buyers, by_price[first:], volume)))
+    heapq.heapify(candidates)
+
+    heap = []
+    while candidates:
+        bound, seller, pair, ware, sell, buy, qty = heapq.heappop(candidates)
+        if len(heap) == limit and -bound < heap[0][0]:
+            break
+        if buy is None:
+            buyers, usable, volume = qty
+            if use_distance:
+                player_leg = player_legs[sell['index']]
+                sell_sector = stations[sell['index']]['sector_code']
+                sell_floor = player_leg + nearest[sell['index']]
+            for pair, bi in enumerate(sorted(usable), 1):
+                buy = buyers[bi]
+                qty = quantity(sell, available(buy), volume)
                 if qty <= 0:
                     continue
-                profit_per = buy['price'] - sell['price']
-                total = profit_per * qty
-                # Compute the distance between seller and buyer via the chosen variant.
-                dist_sell_buy = shortest_path_distance_variant(
-                    graph=nav_graph,
-                    start=station_offset + sell['index'],
-                    goal=station_offset + buy['index'],
-                    variant=variant
-                )
-                # If there is no valid path through the allowed sectors, skip the trade.
-                if not math.isfinite(dist_sell_buy):
+                bound = (buy['price'] - sell['price']) * qty
+                if use_distance:
+                    if buy['index'] == sell['index']:
+                        bound = distance_bound(bound, player_leg)
+                    else:
+                        least = sell_floor + nearest[buy['index']] + sector_distance_floor(
+                            sell_sector, stations[buy['index']]['sector_code'])
+                        if not math.isfinite(least):
+                            continue
+                        bound = distance_bound(bound, least)
+                heapq.heappush(candidates, (-bound, seller, pair, ware, sell, buy, qty))
+            continue
+        # Compute the distance between seller and buyer via the avoidance
+        # variant the flags select.
+        variant = tradeVariant(sell, buy, avoid_illegal, avoid_hostile)
+        dist_sell_buy = station_distance_variant(sell['index'], buy['index'], variant)
+        # If there is no valid path through the allowed sectors, skip the trade.
+        if not math.isfinite(dist_sell_buy):
+            continue
+        # Sellers the player cannot reach never got this far
+        player_leg = player_legs[sell['index']]
+        profit_per = buy['price'] - sell['price']
+        total = profit_per * qty
+        dist = dist_sell_buy + player_leg
+        # Use distance weighting if requested
+        score = (total / (dist / 1000.0)) if use_distance and dist > 0 else total
+        # Earlier trades win ties, so the heap orders on (score, -seller, -pair)
+        key = (score, -seller, -pair)
+        if len(heap) == limit and key < heap[0][:3]:
+            continue
+        deal = {
+            'ware': ware,
+            'from': sell,
+            'to': buy,
+            'qty': qty,
+            'profit_per': profit_per,
+            'total': total,
+            'distance': dist,
+            'sell_buy_dist': dist_sell_buy,
+            'player_dist': player_leg,
+            'score': score
+        }
+        if len(heap) < limit:
+            heapq.heappush(heap, key + (deal,))
+        else:
+            heapq.heapreplace(heap, key + (deal,))
+    return [entry[-1] for entry in sorted(heap, key=lambda x: x[:3], reverse=True)]
+
+TRADE_RUN_WIDTH = 8
+TRADE_RUN_BRANCH = 8
+TRADE_RUN_SECONDS = 30.0
+
+def planTradeRun(legs, max_cargo=None, use_distance=False, origin=None,
+                 cargo_limit=None, credits=None, avoid_illegal=False,
+                 avoid_hostile=False, width=TRADE_RUN_WIDTH,
+                 branch=TRADE_RUN_BRANCH, seconds=TRADE_RUN_SECONDS):
+    """Plan a run of up to legs chained trades, each starting where the
+    last one sold, and return the best run found.
+
+    The run is grown by beam search: each of the width best partial runs
+    is extended with its branch best next trades from getProfitableTrades,
+    given the stock and credits left after the earlier legs.  Runs ending
+    at the same station with the same trades are only kept once, and no
+    new runs are extended once seconds have passed.  Runs are scored on
+    their total profit, per kilometre when use_distance is set.
+
+    Returns {'legs', 'profit', 'distance', 'score'}, with no legs when no
+    trade is possible.
+    """
+    deadline = time.time() + seconds
+    start = {'legs': [], 'profit': 0.0, 'distance': 0.0, 'score': 0.0,
+             'used': {}, 'credits': credits, 'station': None}
+    best = start
+    beam = [start]
+    for _ in range(legs):
+        extended = []
+        seen = set()
+        for run in beam:
+            if time.time() > deadline:
+                break
+            deals = getProfitableTrades(branch, max_cargo, use_distance,
+                                        origin if run['station'] is None else None,
+                                        cargo_limit, run['credits'], avoid_illegal, avoid_hostile,
+                                        origin_station=run['station'], used=run['used'])
+            for d in deals:
+                station = d['to']['index']
+                key = (station, frozenset((id(leg['from']), id(leg['to'])) for leg in run['legs'] + [d]))
+                if key in seen:
                     continue
-                # Compute the player's leg if an origin is provided.  Avoid-hostile
-                # sectors apply to the player path; illegal sectors do not.
-                if origin is not None:
-                    origin_sector = playerLocation.get('sector_code') if playerLocation is not None else None
-                    player_variant = 'hostile' if avoid_hostile else 'none'
-                    player_leg = distance_from_point_to_station_variant(
-                        pos=origin,
-                        sector_code=origin_sector,
-                        station_idx=sell['index'],
-                        variant=player_variant
-                    )
-                    # If the player cannot reach the selling station without travelling through hostile sectors, skip.
-                    if not math.isfinite(player_leg):
-                        continue
-                else:
-                    player_leg = 0.0
-                dist = dist_sell_buy + player_leg
-                # Use distance weighting if requested
-                score = (total / (dist / 1000.0)) if use_distance and dist > 0 else total
-                key = score
-                deal = {
-                    'ware': ware,
-                    'from': sell,
-                    'to': buy,
-                    'qty': qty,
-                    'profit_per': profit_per,
-                    'total': total,
-                    'distance': dist,
-                    'sell_buy_dist': dist_sell_buy,
-                    'player_dist': player_leg,
-                    'score': score
-                }
-                if len(heap) < limit:
-                    heapq.heappush(heap, (key, counter, deal))
-                else:
-                    if key > heap[0][0]:
-                        heapq.heapreplace(heap, (key, counter, deal))
-                counter += 1
-    return [d for _, __, d in sorted(heap, key=lambda x: x[0], reverse=True)]
+                seen.add(key)
+                used = dict(run['used'])
+                used[id(d['from'])] = used.get(id(d['from']), 0) + d['qty']
+                used[id(d['to'])] = used.get(id(d['to']), 0) + d['qty']
+                profit = run['profit'] + d['total']
+                distance = run['distance'] + d['distance']
+                extended.append({
+                    'legs': run['legs'] + [d],
+                    'profit': profit,
+                    'distance': distance,
+                    'score': profit / (distance / 1000.0) if use_distance and distance > 0 else profit,
+                    'used': used,
+                    'credits': None if run['credits'] is None else run['credits'] + d['total'],
+                    'station': station
+                })
+        if not extended:
+            break
+        extended.sort(key=lambda r: r['score'], reverse=True)
+        beam = extended[:width]
+        if beam[0]['score'] > best['score']:
+            best = beam[0]
+    return {key: best[key] for key in ('legs', 'profit', 'distance', 'score')}
+
+def shipHold(ship):
+    """Return the storage macro and hold size of a ship, or (None, None)
+    when none of its storages are listed in ship_hold_sizes
+    """
+    for storage in ship.findall(".//component[@class='storage']"):
+        macro = storage.get('macro')
+        if macro in ship_hold_sizes:
+            return macro, ship_hold_sizes[macro]
+    return None, None
+
+def getFleetShips():
+    """Return (ship, hold size) for every space-worthy player-owned ship
+    with a known cargo hold
+    """
+    fleet = []
+    for ship in allShips:
+        if ship.get('owner') != 'player' or ship.get('state') == 'wreck':
+            continue
+        hold, size = shipHold(ship)
+        if hold is not None:
+            fleet.append((ship, size))
+    return fleet
+
+FLEET_TRADE_CHOICES = 16
+
+def assignFleetTrades(ships=None, use_distance=False, credits=None,
+                      avoid_illegal=False, avoid_hostile=False,
+                      choices=FLEET_TRADE_CHOICES):
+    """Give every ship at most one trade so that no two ships claim the
+    same station stock, and return the (ship, deal) assignments best first.
+
+    ships defaults to getFleetShips().  Assignment is greedy: the best
+    scoring trade of any free ship is taken next, given the stock and
+    credits claimed so far.  Each ship ranks its best choices trades from
+    where it is once; claims only ever lower scores, so a trade that lost
+    stock is scored again and put back, and a ship only ranks again once
+    its queue falls below the worst trade it ranked.
+    """
+    if ships is None:
+        ships = getFleetShips()
+    used = {}
+    remaining = credits
+    # (-score, ship, choice, sequence, deal); deal None marks the end of a
+    # ship's choices, so ranking it again comes after all of them.  The
+    # sequence number keeps equal entries from comparing their deals.
+    queue = []
+    sequence = itertools.count()
+
+    def rank(i):
+        ship, hold = ships[i]
+        deals = getProfitableTrades(choices, None, use_distance, getPosition(ship), hold,
+                                    remaining, avoid_illegal, avoid_hostile,
+                                    used=used, origin_sector=ship.get('sector_code'))
+        for choice, deal in enumerate(deals):
+            heapq.heappush(queue, (-deal['score'], i, choice, next(sequence), deal))
+        if len(deals) == choices:
+            heapq.heappush(queue, (-deals[-1]['score'], i, choices, next(sequence), None))
+
+    for i in range(len(ships)):
+        rank(i)
+    assigned = set()
+    assignments = []
+    while queue:
+        _, i, choice, _, deal = heapq.heappop(queue)
+        if i in assigned:
+            continue
+        if deal is None:
+            rank(i)
+            continue
+        sell, buy = deal['from'], deal['to']
+        qty = min(deal['qty'], sell['amount'] - used.get(id(sell), 0), buy['amount'] - used.get(id(buy), 0))
+        if remaining is not None and sell['price'] > 0:
+            qty = min(qty, int(remaining // sell['price']))
+        if qty < deal['qty']:
+            # Other ships claimed part of this trade; score what is left
+            if qty > 0:
+                deal = dict(deal, qty=qty, total=deal['profit_per'] * qty)
+                dist = deal['distance']
+                deal['score'] = (deal['total'] / (dist / 1000.0)) if use_distance and dist > 0 else deal['total']
+                heapq.heappush(queue, (-deal['score'], i, choice, next(sequence), deal))
+            continue
+        used[id(sell)] = used.get(id(sell), 0) + qty
+        used[id(buy)] = used.get(id(buy), 0) + qty
+        if remaining is not None:
+            remaining -= qty * sell['price']
+        assigned.add(i)
+        assignments.append((ships[i][0], deal))
+    return assignments
 
 def buildProximityInfo(oLocation, sLocation, closest, distance):
     infos = []
@@ -703,9 +1553,16 @@ def buildProximityInfo(oLocation, sLocation, closest, distance):
     return infos
 
 def getPP(code):
-    search = allStations + allShips + dataVaults
-    for resource in search:
-        if resource.get('code') == code:
+    # first match in allStations, then allShips, then dataVaults
+    for connection in ["stations", "ships", "objects"]:
+        for resource in codeComponents.get(code, []):
+            if resource.getparent().get('connection') != connection or resource.get('class') == 'gate':
+                continue
+            if connection == "objects":
+                if resource.get('class') != "datavault":
+                    continue
+            elif resource.get('state') == "wreck" and args.wrecks is False:
+                continue
             return getParPos(resource)
 
 def getParPos(obj, positions=None):
@@ -738,34 +1595,65 @@ def getParPos(obj, positions=None):
         return positions
     return getParPos( obj.getparent(), positions )
 
-def getPosition(obj, position=None):
-    if position == None:
-        position = {'x':0.0, 'y':0.0, 'z':0.0, 'pitch':0.0, 'roll':0.0, 'yaw':0.0}
-    
+POSITION_KEYS = ['x', 'y', 'z', 'pitch', 'roll', 'yaw']
+
+def getOffsetTerms(obj):
+    """Return the non-zero offsets obj itself adds to a position, per key, in
+    the order they are summed: the macro's zone offset first, then its own."""
+    terms = {key: [] for key in POSITION_KEYS}
     macro = obj.get('macro')
     if macro != None:
         if macro in sector_zone_offsets:
             for key in sector_zone_offsets[macro].keys():
-                position[key] += sector_zone_offsets[macro][key]
+                if sector_zone_offsets[macro][key]:
+                    terms[key].append(sector_zone_offsets[macro][key])
     objpos = obj.find('./offset/position')
     if objpos != None:
-        position['x'] += float(objpos.get('x')) if 'x' in objpos.attrib else 0.0
-        position['y'] += float(objpos.get('y')) if 'y' in objpos.attrib else 0.0
-        position['z'] += float(objpos.get('z')) if 'z' in objpos.attrib else 0.0
+        for key in ['x', 'y', 'z']:
+            if key in objpos.attrib and float(objpos.get(key)):
+                terms[key].append(float(objpos.get(key)))
     objrot = obj.find('./offset/rotation')
     if objrot != None:
-        position['pitch'] += float(objrot.get('pitch')) if 'pitch' in objrot.attrib else 0.0
-        position['roll'] += float(objrot.get('roll')) if 'roll' in objrot.attrib else 0.0
-        position['yaw'] += float(objrot.get('yaw')) if 'yaw' in objrot.attrib else 0.0
+        for key in ['pitch', 'roll', 'yaw']:
+            if key in objrot.attrib and float(objrot.get(key)):
+                terms[key].append(float(objrot.get(key)))
+    return terms
+
+def getPositionChain(obj):
+    """Return the offsets obj and all its ancestors up to the galaxy add to a
+    position, innermost first.  Chains are cached per element, so the zones,
+    sectors and clusters shared by many objects are only resolved once."""
+    chain = position_chains.get(obj)
+    if chain is None:
+        terms = getOffsetTerms(obj)
+        if ('class') in obj.attrib and obj.get('class') == 'galaxy':
+            chain = {key: tuple(terms[key]) for key in POSITION_KEYS}
+        else:
+            parent = getPositionChain(obj.getparent())
+            chain = {key: tuple(terms[key]) + parent[key] for key in POSITION_KEYS}
+        position_chains[obj] = chain
+    return chain
+
+def getPosition(obj, position=None):
+    if position == None:
+        position = {'x':0.0, 'y':0.0, 'z':0.0, 'pitch':0.0, 'roll':0.0, 'yaw':0.0}
+
+    # Add the offsets one at a time, innermost first, exactly as walking up
+    # the tree would, so the rounding (and the int() below) never changes.
+    terms = getOffsetTerms(obj)
     if ('class') in obj.attrib and obj.get('class') == 'galaxy':
-        position['x'] = int(position['x'])
-        position['y'] = int(position['y'])
-        position['z'] = int(position['z'])
-        position['pitch'] = int(position['pitch'])
-        position['roll'] = int(position['roll'])
-        position['yaw'] = int(position['yaw'])
-        return position
-    return getPosition( obj.getparent(), position )
+        chain = None
+    else:
+        chain = getPositionChain(obj.getparent())
+    for key in POSITION_KEYS:
+        value = position[key]
+        for term in terms[key]:
+            value += term
+        if chain is not None:
+            for term in chain[key]:
+                value += term
+        position[key] = int(value)
+    return position
 
 def printLbDv(resources, title, level=1):
     for resource in resources:
@@ -868,12 +1756,9 @@ def getDupes(code=None):
     dupes = []
     wanted = [ code ]
     if code == None:
-        wanted = duplicates
+        wanted = duplicates.keys()
     for dupeCode in wanted:
-        for obj in allComponents:
-            if obj.get('code') == dupeCode:
-                obj.set('location', str(getPosition(obj)))
-                dupes += [obj]
+        dupes += getDupeObjects(dupeCode)
     return dupes
 
 def dumpDupes(code=None):
@@ -936,22 +1821,17 @@ def printErlkingVaults():
 def setLevel(level):
     args.info = level
 
-print("Processing XML...")
-start = time.time()
-sectors = root.findall(".//universe/component/connections/connection/component/connections/connection/component[@class='sector']")
-for sector in sectors:
+def processSector(sector):
+    global warnings, duplicates, allComponents, allStations, allShips, freeShips, xenonShips
+    global khaakShips, khaakStations, dataVaults, erlkingVaults, lockboxes, flotsam
+    global phq, playerLocation, playerInShip, playerCargo, playerCargoType
+    sectors.append(sector)
     sectorMacro = sector.get('macro')
     sectorId = sector.get('id')
     sectorCode = sector.get('code')
     sectorName = sector_macros[sectorMacro] if sectorMacro in sector_macros else ""
     sector.set('sector_name', sectorName)
 
-    owner = sector.get('owner')
-    if owner and owner in illegal_factions:
-        illegal_sectors.add(sectorCode)
-    if owner and owner in hostile_factions:
-        hostile_sectors.add(sectorCode)
-
     updateStatsInfo(stats, sector.get('owner'), "sectors")
 
     sectorCodes[sectorCode] = sector
@@ -959,6 +1839,7 @@ for sector in sectors:
         warnings += ["WARNING: Sector Shares code with another Object. Sector: " + sectorName + ", Code: " + sectorCode]
     allCodes[sectorCode] = sector
     sectorNames[sectorName] = sector
+    contents = sectorContents.setdefault(sectorCode, newSectorContents())
 
     # gather all zone components so we can detect jump gates/accelerators
     zones = sector.findall('.//component[@class="zone"]')
@@ -985,9 +1866,10 @@ for sector in sectors:
         myCode = resource.get('code')
 
         if myCode != None:
+            codeComponents[myCode] += [resource]
             if myCode in allCodes:
                 warnings += ["WARNING: Duplicate code found for: " + myCode]
-                duplicates += [myCode]
+                duplicates[myCode] = codeComponents[myCode]
                 if connection == "stations" and myCode in stationCodes:
                     warnings += ["WARNING: WARNING: The duplicate is another STATION. Two or more stations have the same code: " + myCode]
                 elif connection == "ships" and myCode in shipCodes:
@@ -1000,14 +1882,9 @@ for sector in sectors:
             playerLocation = resource
             if not playerInShip and resource.get('class', '').startswith('ship'):
                 playerInShip = True
-                hold = None
-                for storage in resource.findall(".//component[@class='storage']"):
-                    macro = storage.get('macro')
-                    if macro in ship_hold_sizes:
-                        hold = macro
-                        break
+                hold, size = shipHold(resource)
                 if hold is not None:
-                    playerCargo = ship_hold_sizes.get(hold)
+                    playerCargo = size
                     if 'container' in hold:
                         playerCargoType = 'container'
                     elif 'liquid' in hold:
@@ -1030,6 +1907,7 @@ for sector in sectors:
             gates.append({'sector_code': sectorCode, 'pos': gate_pos, 'id': gate_id, 'link': link_id})
             idx = len(gates) - 1
             sector_gates[sectorCode].append(idx)
+            contents['gates'] += [resource]
             continue
 
         if connection == "stations":
@@ -1040,6 +1918,7 @@ for sector in sectors:
                 phq = resource
                 resource.set('location', str(getPosition(resource)))
             allStations += [resource]
+            contents['stations'] += [resource]
             if myCode != None:
                 stationCodes[myCode] = resource
             if resource.get('owner') == "khaak":
@@ -1086,6 +1965,7 @@ for sector in sectors:
             elif (resource.get('owner') == "khaak"):
                 khaakShips += [resource]
             allShips += [resource]
+            contents['ships'] += [resource]
             if myCode != None:
                 shipCodes[myCode] = resource
             updateStatsInfo(stats, resource.get('owner'), "ships", resource.get('class'))
@@ -1093,6 +1973,7 @@ for sector in sectors:
             compClass = resource.get('class')
             if compClass == "datavault":
                 dataVaults += [resource]
+                contents['vaults'] += [resource]
                 if myCode != None:
                     vaultCodes[myCode] = resource
             else:
@@ -1102,8 +1983,10 @@ for sector in sectors:
                         vaultCodes[myCode] = resource
                 else:
                     flotsam += [resource]
+                    contents['flotsam'] += [resource]
         elif connection == "lockboxes":
             lockboxes += [resource]
+            contents['lockboxes'] += [resource]
             if myCode != None:
                 lockboxCodes[myCode] = resource
         else:
@@ -1113,40 +1996,497 @@ for sector in sectors:
                 ignoredConnections[connection] = ignoredConnections[connection] +1
             else:
                 ignoredConnections[connection] = 1
-print('Done. Time: %.2f\n' % (time.time() - start))
 
-nav_graph, station_offset = build_navigation_graph()
+    if snapshotSectors is not None:
+        pruneForSnapshot(sector, resources)
+        snapshotSectors.append(sector)
+    elif not args.shell:
+        for resource in resources:
+            if not resourceDetailWanted(resource):
+                pruneResource(resource)
+
+# Below its <offset>, a resource's subtree (crew, equipment, cargo, trade offers
+# ...) is only read by the sector walk itself, by the -i3 printers, by the XML
+# dump and by the shell.  Work out from the flags which resources will be
+# printed in detail so the rest can be discarded as soon as they are processed.
+detailCodes = {c for c in (args.code, args.xml) if c is not None}
+
+def resourceDetailWanted(resource):
+    if resource.get('code') in detailCodes:
+        return True
+    # --fleet reads the cargo hold of every player-owned ship
+    if args.fleet and resource.get('owner') == "player" and \
+       resource.getparent().get('connection') == "ships":
+        return True
+    if int(args.info) < 3:
+        return False
+    connection = resource.getparent().get('connection')
+    owner = resource.get('owner')
+    if resource is playerLocation and args.whereswally:
+        return True
+    if connection == "ships":
+        return (owner == "ownerless" and args.ownerless) or \
+               (owner == "xenon" and args.xenon) or \
+               (owner == "khaak" and args.khaak)
+    if connection == "stations":
+        return owner == "khaak" and args.khaakstations
+    if connection == "objects":
+        if resource.get('class') == "datavault":
+            return args.datavaults
+        return resource.get('macro', '').startswith("landmarks_erlking_vault") and args.erlking
+    if connection == "lockboxes":
+        return args.lockboxes
+    return False
+
+def pruneResource(resource):
+    """Drop everything below a resource apart from the <offset> used to locate it"""
+    for child in list(resource):
+        if child.tag != 'offset':
+            resource.remove(child)
+
+SECTOR_PATH = ".//universe/component/connections/connection/component/connections/connection/component[@class='sector']"
+
+def isClusterComponent(component):
+    """Return True if component sits at universe/component/connections/connection/component,
+    which is where the sector walk expects to find the clusters."""
+    connection = component.getparent()
+    if connection is None or connection.tag != 'connection':
+        return False
+    connections = connection.getparent()
+    if connections is None or connections.tag != 'connections':
+        return False
+    galaxy = connections.getparent()
+    if galaxy is None or galaxy.tag != 'component':
+        return False
+    universe = galaxy.getparent()
+    return universe is not None and universe.tag == 'universe'
+
+class InflateReader:
+    """Read-only file object that inflates a .gz savefile in a background thread.
+
+    Decompressed chunks are handed over through a bounded queue, so inflating
+    and parsing run at the same time (zlib and lxml both release the GIL) while
+    at most a few chunks are held in memory.  inflateTime and waitTime record
+    how long the inflate thread worked and how long the parser sat waiting on
+    it, which gives the overlap achieved.
+    """
+    def __init__(self, savefile, chunkSize=1 << 20, depth=8):
+        self.queue = queue.Queue(maxsize=depth)
+        self.stopped = threading.Event()
+        self.chunk = b''
+        self.offset = 0
+        self.eof = False
+        self.inflateTime = 0.0
+        self.waitTime = 0.0
+        self.thread = threading.Thread(target=self.inflate, args=(savefile, chunkSize), daemon=True)
+        self.thread.start()
+
+    def inflate(self, savefile, chunkSize):
+        try:
+            with gzip_backend.open(savefile, 'rb') as f:
+                while not self.stopped.is_set():
+                    start = time.time()
+                    chunk = f.read(chunkSize)
+                    self.inflateTime += time.time() - start
+                    if not chunk:
+                        break
+                    self.put(chunk)
+        except Exception as e:
+            self.put(e)
+        self.put(b'')
+
+    def put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def read(self, size=-1):
+        if self.offset >= len(self.chunk):
+            if self.eof:
+                return b''
+            start = time.time()
+            item = self.queue.get()
+            self.waitTime += time.time() - start
+            if isinstance(item, Exception):
+                raise item
+            if not item:
+                self.eof = True
+            self.chunk = item
+            self.offset = 0
+        if size is None or size < 0:
+            size = len(self.chunk) - self.offset
+        data = self.chunk[self.offset:self.offset + size]
+        self.offset += len(data)
+        return data
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def streamSavefile(source, full=False):
+    """Parse the savefile with iterparse straight off the (gzip) stream.
+
+    Sectors are processed as soon as their cluster has been parsed, so the
+    sector walk overlaps with decompression and parsing and the raw XML is
+    never held in memory.  Everything the miner needs lives in <info> and
+    <universe>, so unless full is set we stop reading at </universe> and
+    skip the trailing economy logs, stats and scripts.
+    """
+    tree_root = None
+    depth = 0
+    for event, elem in etree.iterparse(source, events=('start', 'end'), tag=('component', 'universe'), **PARSER_OPTIONS):
+        if tree_root is None:
+            tree_root = elem.getroottree().getroot()
+        if elem.tag == 'universe':
+            if event == 'end' and not full:
+                break
+            continue
+        if event == 'start':
+            depth += 1
+            continue
+        depth -= 1
+        # Clusters are the second level of components (galaxy -> cluster -> sector)
+        if depth == 1 and isClusterComponent(elem):
+            for sector in elem.findall("./connections/connection/component[@class='sector']"):
+                processSector(sector)
+    return tree_root
+
+# -----------------------------------------------------------------------------
+# Snapshot cache.  The first run against a save writes a cut-down copy of the
+# universe next to it holding just what the sector walk and the print functions
+# read: component attributes, offsets, trade offers, gate links, the player's
+# ship hold and the equipment/wares shown at -i3.  Later runs against the same
+# save load that instead and re-run the (now tiny) sector walk over it.  The
+# file is one line of JSON naming the save it was taken from, followed by the
+# zlib-compressed XML, so loading it never runs anything from the file.
+SNAPSHOT_VERSION = 4
+SNAPSHOT_SUFFIX = ".x4snap"
+
+# Paths below a resource that need to survive in the snapshot.  These mirror
+# the queries made by the sector walk and by printShip()/printLbDv().
+SNAPSHOT_RESOURCE_PATHS = [
+    "./offset/position",
+    "./offset/rotation",
+    ".//component[@class='player']",
+    "./connections/connection/component[@class='engine']",
+    "./connections/connection/component[@class='shieldgenerator']",
+    "./connections/connection/component[@class='weapon']",
+    "./connections/connection/component[@class='turret']",
+    "./software",
+    ".//ammunition/available/item",
+]
+SNAPSHOT_STATION_PATHS = [
+    ".//trade/offers//trade",
+]
+SNAPSHOT_GATE_PATHS = [
+    "./connections/connection",
+    "./connections/connection/connected",
+]
+SNAPSHOT_CONTAINER_PATHS = [
+    ".//ware",
+    ".//component[@class='collectableblueprints']",
+    ".//component[@class='collectablewares']",
+]
+SNAPSHOT_PLAYER_PATHS = [
+    ".//component[@class='storage']",
+]
+SNAPSHOT_SECTOR_PATHS = [
+    "./offset/position",
+    "./offset/rotation",
+    ".//component[@class='zone']",
+    ".//component[@class='zone']/offset/position",
+    ".//component[@class='zone']/offset/rotation",
+    "./connections/connection/component/offset/position",
+    "./connections/connection/component/offset/rotation",
+]
+
+def snapshotPaths(resource):
+    connection = resource.getparent().get('connection')
+    paths = SNAPSHOT_RESOURCE_PATHS
+    if connection == "stations":
+        paths = paths + SNAPSHOT_STATION_PATHS
+    elif connection in ["objects", "lockboxes"]:
+        paths = paths + SNAPSHOT_CONTAINER_PATHS
+    if resource.get('class') == 'gate':
+        paths = paths + SNAPSHOT_GATE_PATHS
+    if resource is playerLocation or (connection == "ships" and resource.get('owner') == "player"):
+        paths = paths + SNAPSHOT_PLAYER_PATHS
+    return paths
+
+def keepWithAncestors(keep, elem, top):
+    while elem is not None and elem not in keep:
+        keep.add(elem)
+        if elem is top:
+            break
+        elem = elem.getparent()
+
+def writeKept(xf, elem, keep, snapshotted):
+    """Serialise elem and its descendants in keep, writing the (already pruned)
+    snapshotted sectors out whole"""
+    if elem in snapshotted:
+        xf.write(elem)
+        return
+    with xf.element(elem.tag, dict(elem.attrib)):
+        if elem.text:
+            xf.write(elem.text)
+        for child in elem:
+            if child in keep:
+                writeKept(xf, child, keep, snapshotted)
+
+def pruneForSnapshot(sector, resources):
+    """Cut a processed sector down, in place, to what the snapshot keeps.
+
+    This is a superset of everything any flag other than -X and the shell
+    reads, so it replaces pruneResource() on runs that write a snapshot.
+    """
+    keep = set()
+    keepWithAncestors(keep, sector, sector)
+    for path in SNAPSHOT_SECTOR_PATHS:
+        for elem in sector.iterfind(path):
+            keepWithAncestors(keep, elem, sector)
+    for resource in resources:
+        keepWithAncestors(keep, resource, sector)
+        for path in snapshotPaths(resource):
+            for elem in resource.iterfind(path):
+                keepWithAncestors(keep, elem, sector)
+    for elem in keep:
+        for child in list(elem):
+            if child not in keep:
+                elem.remove(child)
+
+def buildSnapshot(root, snapshotted):
+    """Serialise the pruned sectors with everything above them that is still
+    read: cluster/galaxy offsets, the player's money, relations and licences."""
+    keep = set()
+    for sector in snapshotted:
+        keepWithAncestors(keep, sector, root)
+        ancestor = sector.getparent()
+        while ancestor is not None:
+            if ancestor.tag == 'component':
+                for path in ["./offset/position", "./offset/rotation"]:
+                    for elem in ancestor.findall(path):
+                        keepWithAncestors(keep, elem, root)
+            ancestor = ancestor.getparent()
+    player_info = root.find('.//player')
+    if player_info is not None:
+        keepWithAncestors(keep, player_info, root)
+    for elem in root.findall(".//faction[@id='player']/relations/relation") + \
+                root.findall(".//licence[@type='station_illegal']"):
+        keepWithAncestors(keep, elem, root)
+    buffer = io.BytesIO()
+    with etree.xmlfile(buffer) as xf:
+        writeKept(xf, root, keep, set(snapshotted))
+    return buffer.getvalue()
+
+def savefileKey(savefile):
+    st = os.stat(savefile)
+    return {'savefile': os.path.abspath(savefile), 'size': st.st_size, 'mtime': st.st_mtime_ns}
+
+def savefileHash(savefile):
+    digest = hashlib.sha1()
+    with open(savefile, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def writeSnapshot(snapfile, snapshot):
+    header = {key: value for key, value in snapshot.items() if key != 'skeleton'}
+    try:
+        with open(snapfile + ".tmp", 'wb') as f:
+            f.write(json.dumps(header).encode('utf-8') + b'\n')
+            f.write(snapshot['skeleton'])
+        os.replace(snapfile + ".tmp", snapfile)
+    except OSError as e:
+        print("WARNING: Failed to write snapshot " + snapfile + ": " + str(e))
+
+def loadSnapshot(savefile):
+    """Return the snapshot for savefile, or None if there isn't a valid one.
+
+    A snapshot matches when the path, size and mtime are unchanged.  If only
+    the path or mtime differ (the save was copied or touched) the content
+    hash decides, and the snapshot is re-keyed so the next run skips the hash.
+    """
+    snapfile = savefile + SNAPSHOT_SUFFIX
+    if not os.path.isfile(snapfile):
+        return None
+    try:
+        with open(snapfile, 'rb') as f:
+            header = f.readline()
+            snapshot = json.loads(header)
+            if not isinstance(snapshot, dict):
+                raise ValueError("snapshot header is not an object")
+            snapshot['skeleton'] = f.read()
+    except (OSError, ValueError):
+        print("WARNING: Ignoring unreadable snapshot: " + snapfile)
+        return None
+    if snapshot.get('version') != SNAPSHOT_VERSION:
+        return None
+    key = savefileKey(savefile)
+    if key['size'] != snapshot.get('size'):
+        return None
+    if key['savefile'] != snapshot.get('savefile') or key['mtime'] != snapshot.get('mtime'):
+        if savefileHash(savefile) != snapshot.get('sha1'):
+            return None
+        snapshot.update(key)
+        writeSnapshot(snapfile, snapshot)
+    return snapshot
+
+def saveSnapshot(savefile, root, snapshotted):
+    snapshot = savefileKey(savefile)
+    snapshot['version'] = SNAPSHOT_VERSION
+    snapshot['sha1'] = savefileHash(savefile)
+    snapshot['skeleton'] = zlib.compress(buildSnapshot(root, snapshotted), 1)
+    writeSnapshot(savefile + SNAPSHOT_SUFFIX, snapshot)
+
+snapshot = None
+snapshotSectors = None
+if not (args.no_snapshot or args.shell or args.xml):
+    snapshot = loadSnapshot(args.savefile)
+    if snapshot is None:
+        snapshotSectors = []
+
+if snapshot is not None:
+    print("Loading Snapshot....")
+    start = time.time()
+    root = etree.fromstring(zlib.decompress(snapshot['skeleton']), parser=OPTIMIZED_PARSER)
+    snapshot = None
+    print('Done. Time: %.2f' % (time.time() - start))
+
+    print("Processing XML...")
+    start = time.time()
+    for sector in root.findall(SECTOR_PATH):
+        processSector(sector)
+    print('Done. Time: %.2f\n' % (time.time() - start))
+elif args.no_stream:
+    print("Loading Savefile....")
+    start = time.time()
+    rawxml = None
+    if args.savefile.endswith(".gz"):
+        with gzip_backend.open(args.savefile, 'rb') as f:
+            rawxml = f.read()
+    else:
+        with open(args.savefile, 'rb') as f:
+            rawxml = f.read()
+    print('Done. Time: %.2f' % (time.time() - start))
+
+    if rawxml is None:
+        print("ERROR - Failed to parse savefile")
+        sys.exit(1)
+
+    print("Parsing XML...")
+    start = time.time()
+    root = etree.fromstring(rawxml, parser=OPTIMIZED_PARSER)
+    rawxml = None
+    print('Done. Time: %.2f' % (time.time() - start))
+
+    print("Processing XML...")
+    start = time.time()
+    for sector in root.findall(SECTOR_PATH):
+        processSector(sector)
+    print('Done. Time: %.2f\n' % (time.time() - start))
+else:
+    print("Loading and Processing Savefile (streaming)....")
+    start = time.time()
+    source = InflateReader(args.savefile) if args.savefile.endswith(".gz") else open(args.savefile, 'rb')
+    with source:
+        root = streamSavefile(source, full=args.shell)
+    if root is None:
+        print("ERROR - Failed to parse savefile")
+        sys.exit(1)
+    elapsed = time.time() - start
+    if isinstance(source, InflateReader):
+        # Without the pipeline the parser would also have had to do the inflating
+        parseTime = elapsed - source.waitTime
+        print('Done. Time: %.2f (inflate %.2f, parse %.2f, overlap speedup %.2fx using %s)\n' %
+              (elapsed, source.inflateTime, parseTime, (source.inflateTime + parseTime) / elapsed, gzip_backend.__name__))
+    else:
+        print('Done. Time: %.2f\n' % elapsed)
 
-if args.avoid_illegal_sectors:
-    for gidx, gate in enumerate(gates):
-        if gate['sector_code'] in illegal_sectors:
-            illegal_nodes.add(gidx)
-    for si, station in enumerate(stations):
-        if station['sector_code'] in illegal_sectors:
-            illegal_nodes.add(station_offset + si)
+if snapshotSectors is not None:
+    print("Writing Snapshot....")
+    start = time.time()
+    saveSnapshot(args.savefile, root, snapshotSectors)
+    snapshotSectors = None
+    print('Done. Time: %.2f\n' % (time.time() - start))
 
-if args.avoid_hostile_sectors:
-    for gidx, gate in enumerate(gates):
-        if gate['sector_code'] in hostile_sectors:
-            hostile_nodes.add(gidx)
-    for si, station in enumerate(stations):
-        if station['sector_code'] in hostile_sectors:
-            hostile_nodes.add(station_offset + si)
+# Record player credit balance
+player_info = root.find('.//player')
+if player_info is not None:
+    try:
+        playerCredits = int(player_info.get('money', '0'))
+    except ValueError:
+        playerCredits = 0
+
+
+# Determine the player's relations with all factions and which are hostile
+for rel in root.findall(".//faction[@id='player']/relations/relation"):
+    try:
+        val = float(rel.get('relation', '0'))
+        player_relations[rel.get('faction')] = val
+        if val < -0.25:
+            hostile_factions.add(rel.get('faction'))
+    except ValueError:
+        pass
+
+# Determine which factions enforce illegal wares
+for lic in root.findall(".//licence[@type='station_illegal']"):
+    for fac in lic.get('factions', '').split():
+        illegal_factions.add(fac)
+
+
+
+# Sector ownership decides which sectors are illegal or hostile for routing
+for sector in sectors:
+    owner = sector.get('owner')
+    if owner and owner in illegal_factions:
+        illegal_sectors.add(sector.get('code'))
+    if owner and owner in hostile_factions:
+        hostile_sectors.add(sector.get('code'))
+
+nav_graph, station_offset = build_navigation_graph()
+core_graph, station_attachments = build_core_graph(nav_graph, station_offset)
+station_nearest_gate = [min(d for _, d in links) if links else float('inf') for links in station_attachments]
+
+illegal_nodes.update(sectorNodes(illegal_sectors))
+hostile_nodes.update(sectorNodes(hostile_sectors))
 
 # Build variant avoid sets and per-variant caches for pathfinding.
 # 'none'  : no sectors are avoided,
 # 'hostile': avoid sectors owned by hostile factions,
 # 'illegal': avoid sectors where the ware is illegal,
 # 'both'  : avoid both hostile and illegal sectors for illegal wares.
+# The avoid options only decide which variant each route uses.
 variant_avoid_sets = {
     'none': set(),
     'hostile': set(hostile_nodes),
     'illegal': set(illegal_nodes),
     'both': set(hostile_nodes | illegal_nodes),
 }
+# Searches only derive the variants the avoid options can select; any other
+# variant (e.g. asked for from the shell) is added on its first use.
+routing_variants = {'none'}
+if args.avoid_hostile_sectors:
+    routing_variants.add('hostile')
+if args.avoid_illegal_sectors:
+    routing_variants.add('illegal')
+if args.avoid_hostile_sectors and args.avoid_illegal_sectors:
+    routing_variants.add('both')
 # Each variant gets its own path_map_cache and path_cache.
 path_map_cache_variants = {key: {} for key in variant_avoid_sets}
 path_cache_variants = {key: {} for key in variant_avoid_sets}
+path_prev_cache_variants = {key: {} for key in variant_avoid_sets}
+if args.distance_matrix and (args.trades is not None or args.trade_run is not None or args.fleet):
+    for variant in list(routing_variants):
+        precompute_core_distances(variant)
 
 
 if args.ownerless:
@@ -1229,21 +2569,19 @@ if args.factions:
         if lines %2 == 0:
             print("-" * len(line))
 
-if args.trades is not None:
-    trade_args = args.trades
-    limit = 5
+def tradeSettings(trade_args, limit):
+    """Return (limit, max_cargo, use_distance, origin, cargo_limit, credits)
+    from the count and cargo arguments of a trade option and --player.
+    """
     max_cargo = None
     if len(trade_args) >= 1 and trade_args[0] != '':
         limit = int(trade_args[0])
     if len(trade_args) >= 2:
         max_cargo = int(trade_args[1])
-    use_player = args.player
-    print("\nProfitable Trades")
-    print("=================")
     origin_pos = None
     cargo_limit = max_cargo
-    use_distance = args.distance or use_player
-    if use_player:
+    use_distance = args.distance or args.player
+    if args.player:
         if not playerInShip or playerLocation is None:
             print("ERROR: Player is not currently in a ship; cannot use --player option.")
             sys.exit(1)
@@ -1252,24 +2590,21 @@ if args.trades is not None:
             print("ERROR: Unable to determine player's cargo hold size.")
             sys.exit(1)
         cargo_limit = playerCargo if max_cargo is None else min(max_cargo, playerCargo)
-    credits = playerCredits if use_player else None
+    credits = playerCredits if args.player else None
+    return limit, max_cargo, use_distance, origin_pos, cargo_limit, credits
+
+if args.trades is not None:
+    print("\nProfitable Trades")
+    print("=================")
+    use_player = args.player
+    limit, max_cargo, use_distance, origin_pos, cargo_limit, credits = tradeSettings(args.trades, 5)
     deals = getProfitableTrades(limit, max_cargo, use_distance, origin_pos, cargo_limit, credits, args.avoid_illegal_sectors, args.avoid_hostile_sectors)
     for d in deals:
         profit_unit = f"${d['profit_per']:,.0f}"
         total_profit = f"${d['total']:,.0f}"
         # Determine the avoidance variant to compute the route path.
-        is_illegal_trade = d['from'].get('illegal') or d['to'].get('illegal')
-        if args.avoid_hostile_sectors and args.avoid_illegal_sectors and is_illegal_trade:
-            variant = 'both'
-        elif args.avoid_illegal_sectors and is_illegal_trade:
-            variant = 'illegal'
-        elif args.avoid_hostile_sectors:
-            variant = 'hostile'
-        else:
-            variant = 'none'
+        variant = tradeVariant(d['from'], d['to'], args.avoid_illegal_sectors, args.avoid_hostile_sectors)
         # Compute the route between player (if used), seller and buyer.
-        start_node = station_offset + d['from']['index']
-        goal_node = station_offset + d['to']['index']
         if use_player and origin_pos is not None:
             player_variant = 'hostile' if args.avoid_hostile_sectors else 'none'
             player_route = route_from_point_to_station_variant(
@@ -1278,10 +2613,10 @@ if args.trades is not None:
                 d['from']['index'],
                 player_variant
             )
-            seller_to_buyer = shortest_path_route_variant(nav_graph, start_node, goal_node, variant)
+            seller_to_buyer = station_route_variant(d['from']['index'], d['to']['index'], variant)
             route_nodes = player_route + seller_to_buyer[1:]
         else:
-            route_nodes = shortest_path_route_variant(nav_graph, start_node, goal_node, variant)
+            route_nodes = station_route_variant(d['from']['index'], d['to']['index'], variant)
         route_names = route_to_sector_names(route_nodes)
         route_str = " -> ".join(route_names)
         # Build multi-line output
@@ -1307,6 +2642,92 @@ if args.trades is not None:
         else:
             print("Route: (no valid path)")
 
+if args.trade_run is not None:
+    print("\nTrade Run")
+    print("=========")
+    legs, max_cargo, use_distance, origin_pos, cargo_limit, credits = tradeSettings(args.trade_run, 3)
+    run = planTradeRun(legs, max_cargo, use_distance, origin_pos, cargo_limit, credits, args.avoid_illegal_sectors, args.avoid_hostile_sectors)
+    if not run['legs']:
+        print("No profitable trade run found")
+    player_variant = 'hostile' if args.avoid_hostile_sectors else 'none'
+    for leg, d in enumerate(run['legs'], 1):
+        variant = tradeVariant(d['from'], d['to'], args.avoid_illegal_sectors, args.avoid_hostile_sectors)
+        seller_to_buyer = station_route_variant(d['from']['index'], d['to']['index'], variant)
+        # Each leg after the first starts where the previous one sold
+        if leg > 1:
+            start = "Previous buyer"
+            lead_in = station_route_variant(run['legs'][leg - 2]['to']['index'], d['from']['index'], player_variant)
+            route_nodes = lead_in + seller_to_buyer[1:]
+        elif origin_pos is not None:
+            start = "Player"
+            lead_in = route_from_point_to_station_variant(
+                origin_pos,
+                playerLocation.get('sector_code'),
+                d['from']['index'],
+                player_variant
+            )
+            route_nodes = lead_in + seller_to_buyer[1:]
+        else:
+            start = None
+            route_nodes = seller_to_buyer
+        route_names = route_to_sector_names(route_nodes)
+        print("")
+        print(f"Leg {leg}: {d['ware']}")
+        print(f"From: {d['from']['station']} ({d['from']['sector_name']})")
+        print(f"To  : {d['to']['station']} ({d['to']['sector_name']})")
+        print(f"Qty : {d['qty']} | Profit/unit ${d['profit_per']:,.0f} | Total ${d['total']:,.0f}")
+        if start is not None:
+            print(f"{start} -> Seller: {int(d['player_dist']/1000)}km")
+        print(f"Seller -> Buyer : {int(d['sell_buy_dist']/1000)}km")
+        if route_names:
+            print(f"Route: {' -> '.join(route_names)}")
+        else:
+            print("Route: (no valid path)")
+    if run['legs']:
+        print("")
+        print(f"Run profit   : ${run['profit']:,.0f}")
+        print(f"Run distance : {int(run['distance']/1000)}km")
+        if use_distance:
+            print(f"Score        : {int(run['score'])}")
+
+if args.fleet:
+    print("\nFleet Trades")
+    print("============")
+    fleet = getFleetShips()
+    credits = playerCredits if args.player else None
+    assignments = assignFleetTrades(fleet, args.distance, credits, args.avoid_illegal_sectors, args.avoid_hostile_sectors)
+    if not fleet:
+        print("No player-owned ships with a known cargo hold")
+    player_variant = 'hostile' if args.avoid_hostile_sectors else 'none'
+    for ship, d in assignments:
+        variant = tradeVariant(d['from'], d['to'], args.avoid_illegal_sectors, args.avoid_hostile_sectors)
+        ship_route = route_from_point_to_station_variant(
+            getPosition(ship),
+            ship.get('sector_code'),
+            d['from']['index'],
+            player_variant
+        )
+        route_nodes = ship_route + station_route_variant(d['from']['index'], d['to']['index'], variant)[1:]
+        route_names = route_to_sector_names(route_nodes)
+        shipName = " " + ship.get('name') if ship.get('name') != None else ""
+        print("")
+        print(f"Ship: {ship.get('code')}{shipName} ({ship.get('sector_name')})")
+        print(f"Ware: {d['ware']}")
+        print(f"From: {d['from']['station']} ({d['from']['sector_name']})")
+        print(f"To  : {d['to']['station']} ({d['to']['sector_name']})")
+        print(f"Qty : {d['qty']} | Profit/unit ${d['profit_per']:,.0f} | Total ${d['total']:,.0f}")
+        print(f"Ship -> Seller  : {int(d['player_dist']/1000)}km")
+        print(f"Seller -> Buyer : {int(d['sell_buy_dist']/1000)}km")
+        if args.distance:
+            print(f"Score         : {int(d['score'])}")
+        if route_names:
+            print(f"Route: {' -> '.join(route_names)}")
+        else:
+            print("Route: (no valid path)")
+    if fleet:
+        print("")
+        print(f"{len(assignments)} of {len(fleet)} ships assigned, total profit ${sum(d['total'] for _, d in assignments):,.0f}")
+
 if args.xml != None:
     printXML(args.xml)
 
@@ -1324,7 +2745,9 @@ if args.shell:
     print("  getStations('code')       # Fetch information about a specific station (returns an array of stations)")
     print("  getObjects('code')        # Fetch information about any object with a code (returns an array of objets)")
     print("  getSectors('code')        # Fetch information about a specific sector (returns an array of sectors)")
-    print("  getSectorObjects('code')  # Fetch stations and ships currently inside the given sector")
+    print("  getSectorObjects('code')  # Fetch stations, ships, vaults, flotsam, lockboxes and gates inside the given sector")
+    print("  sectorContents['code']    # The same per-sector buckets, keyed by sector code")
+    print("  nearestStations('code', k) # Fetch the k closest stations to an object as (station, distance) pairs")
     print("  printXML('code')          # Print the XML for a resource and its children")
     print("  getDupes('code')          # Fetch all duplicates or those with provided code")
     print("  dumpDupes('code')         # Print all duplicates or those with provided code")
@@ -1335,6 +2758,12 @@ if args.shell:
     print("  update[Ownerless|LockBoxes|DataVaults|ErlkingVaults]() # Update locations for these objects")
     print("  print[Ownerless|LockBoxes|DataVaults|ErlkingVaults]()  # Print these objects information")
     print("  getProfitableTrades(n[, max_cargo, use_distance, origin, avoid_illegal, avoid_hostile])   # Return n most profitable trades")
+    print("  planTradeRun(legs[, max_cargo, use_distance, origin, cargo_limit, credits, avoid_illegal, avoid_hostile])  # Plan a run of chained trades")
+    print("  assignFleetTrades([ships, use_distance, credits, avoid_illegal, avoid_hostile])  # Assign trades to getFleetShips() without sharing stock")
+    print("  setFactionHostile('faction'[, hostile])  # Treat a faction's sectors as hostile (or not) when routing")
+    print("  setSectorIllegal('code'[, illegal])      # Treat a sector as illegal (or not) when routing")
+    print("  shortest_path_route(nav_graph, start, goal[, avoid_nodes])  # Route between two nodes (A* with landmark bounds)")
+    print("  benchmarkRouteSearch(n[, avoid_nodes])                     # Compare Dijkstra and A* node expansions on n random queries")
     print("")
     print("  Eg. Display the ownerless ship locations:")
     print("")
@@ -1342,10 +2771,10 @@ if args.shell:
     print("  >>> printOwnerless()")
     print("")
     print("Or you know, just use python. The root of the xml tree is in var `root`. Other vars include:")
-    print("lists:      sectors duplicates warnings allComponents allStations allShips freeShips")
+    print("lists:      sectors warnings allComponents allStations allShips freeShips")
     print("            xenonShips khaakShips dataVaults erlkingVaults lockboxes flotsam other")
     print("dicts:      sectorNames sectorCodes shipCodes stationCodes vaultCodes lockboxCodes allCodes")
-    print("            ignoredConnections sector_zone_offsets sector_macros")
+    print("            codeComponents duplicates ignoredConnections sector_zone_offsets sector_macros")
     print("")
     print("Examples")
     print("")
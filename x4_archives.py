@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+Read X4 Foundations CAT/DAT archives.
+
+A .cat file is the index of the .dat file next to it.  Each line holds an
+entry's name, size, timestamp and checksum, and the entries are stored back
+to back in the .dat in the order they are listed.
+"""
+import fnmatch
+import mmap
+import os
+
+def parse_cat(cat_path, skipped=None):
+    """
+    Parse a .cat index file and return a list of (name, offset, size).
+
+    Lines without a name, size, timestamp and checksum are left out and do
+    not take up room in the .dat; when skipped is a list they are appended
+    to it.
+    """
+    entries = []
+    offset = 0
+    with open(cat_path, 'rb') as f:
+        for raw in f:
+            line = raw.decode('utf-8', errors='ignore').rstrip('\r\n')
+            parts = line.rsplit(' ', 3)
+            if len(parts) < 4 or not parts[1].isdigit():
+                if skipped is not None:
+                    skipped.append(line)
+                continue
+            size = int(parts[1])
+            entries.append((parts[0], offset, size))
+            offset += size
+    return entries
+
+def match_entry(name, patterns):
+    """
+    True if an entry name matches any of the glob patterns (ignoring case),
+    or if patterns is None.
+    """
+    if patterns is None:
+        return True
+    if isinstance(patterns, str):
+        patterns = (patterns,)
+    name = name.lower()
+    return any(fnmatch.fnmatchcase(name, pattern.lower()) for pattern in patterns)
+
+class CatArchive:
+    """
+    A .cat index and its memory-mapped .dat file.
+
+    The index is parsed once when the archive is opened and the .dat is
+    mapped read-only, so view() hands out memoryview slices of an entry
+    without copying it.  Use as a context manager or call close() when
+    done; views that are still held keep the mapping alive until they are
+    released.
+    """
+
+    def __init__(self, cat_path):
+        self.cat_path = cat_path
+        self.dat_path = os.path.splitext(cat_path)[0] + '.dat'
+        self.skipped = []
+        self.index = parse_cat(cat_path, self.skipped)
+        with open(self.dat_path, 'rb') as dat:
+            if os.fstat(dat.fileno()).st_size:
+                self.dat = mmap.mmap(dat.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                # an empty file cannot be mapped
+                self.dat = b''
+        self.buffer = memoryview(self.dat)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self.buffer is not None:
+            self.buffer.release()
+            self.buffer = None
+            self.dat = None
+
+    def entries(self, patterns=None):
+        """
+        Yield the (name, offset, size) entries whose names match patterns.
+        """
+        for entry in self.index:
+            if match_entry(entry[0], patterns):
+                yield entry
+
+    def view(self, entry):
+        """
+        Return a memoryview of an entry's data in the mapped .dat.
+        """
+        _, offset, size = entry
+        return self.buffer[offset:offset + size]
+
+    def read(self, entry):
+        """
+        Return a copy of an entry's data as bytes.
+        """
+        return self.view(entry).tobytes()
+
+    def files(self, patterns=None):
+        """
+        Yield (name, memoryview) for the entries whose names match patterns.
+        """
+        for entry in self.entries(patterns):
+            yield entry[0], self.view(entry)